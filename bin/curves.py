@@ -0,0 +1,185 @@
+"""
+Count accepted results over a grid of q-value thresholds.
+
+Rather than counting the results below one threshold at a time, the
+q-values of each group of results are sorted once and every threshold is
+found with a single binary search. The curves of many models, levels,
+and PIN files fit in a small array, which is saved as a compressed .npz
+file so that comparisons do not need to reload the result tables.
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import resultstore
+
+QVALUE = "mokapot q-value"
+THRESHOLDS = np.round(np.linspace(0, 0.1, 1001), 6)
+
+
+def accepted(qvalues, thresholds=THRESHOLDS) -> np.ndarray:
+    """
+    Count the q-values at or below each threshold.
+
+    Parameters
+    ----------
+    qvalues : array-like of float
+        The q-values.
+    thresholds : array-like of float
+        The thresholds.
+
+    Returns
+    -------
+    numpy.ndarray
+        The number accepted at each threshold.
+    """
+    qvalues = np.sort(np.asarray(qvalues, dtype=float))
+    return np.searchsorted(qvalues, thresholds, side="right")
+
+
+def group_curves(results, by, qvalue_column=QVALUE, thresholds=THRESHOLDS):
+    """
+    Count the accepted results of each group over a grid of thresholds.
+
+    The results are sorted once by group and q-value, and each group is
+    then a contiguous run in which every threshold is found by binary
+    search.
+
+    Parameters
+    ----------
+    results : pandas.DataFrame
+        The results.
+    by : list of str
+        The columns that define the groups, such as ``["model", "pin_file"]``.
+    qvalue_column : str
+        The column of q-values.
+    thresholds : array-like of float
+        The thresholds.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The number of accepted results, with a row for each group and a
+        column for each threshold.
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    codes = np.zeros(len(results), dtype=np.int64)
+    uniques = []
+    for col in by:
+        col_codes, col_uniques = pd.factorize(results[col], sort=True)
+        codes = codes * len(col_uniques) + col_codes
+        uniques.append(col_uniques)
+
+    qvalues = results[qvalue_column].to_numpy(dtype=float)
+    order = np.lexsort((qvalues, codes))
+    codes = codes[order]
+    qvalues = qvalues[order]
+
+    starts = np.flatnonzero(np.diff(codes, prepend=-1))
+    bounds = np.append(starts, len(codes))
+    counts = np.empty((len(starts), len(thresholds)), dtype=np.int64)
+    for group, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        counts[group] = np.searchsorted(qvalues[start:end], thresholds, "right")
+
+    keys = np.unravel_index(codes[starts], [len(u) for u in uniques])
+    index = pd.MultiIndex.from_arrays(
+        [u.take(k) for u, k in zip(uniques, keys)], names=by
+    )
+    curves = pd.DataFrame(counts, index=index, columns=thresholds)
+    curves.columns.name = "threshold"
+    return curves
+
+
+def store_curves(root, models=None, thresholds=THRESHOLDS) -> pd.DataFrame:
+    """
+    Count the accepted results of each model, level, and PIN file.
+
+    Only the q-values are read from the result store.
+
+    Parameters
+    ----------
+    root : str
+        The result store, as in ``resultstore``.
+    models : list of str, optional
+        The models. By default, every model in the store is used.
+    thresholds : array-like of float
+        The thresholds.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The curves, indexed by model, level, and PIN file.
+    """
+    curves = []
+    for level in resultstore.LEVELS:
+        level_models = resultstore.models(root, level)
+        if models is not None:
+            level_models = [m for m in level_models if m in models]
+
+        if not level_models:
+            continue
+
+        res = resultstore.read(root, level, [QVALUE], models=level_models)
+        res["level"] = level
+        by = ["model", "level", "pin_file"]
+        curves.append(group_curves(res, by, thresholds=thresholds))
+
+    return pd.concat(curves).sort_index()
+
+
+def save(curves, out_file) -> str:
+    """
+    Save curves in a compressed .npz file.
+
+    Parameters
+    ----------
+    curves : pandas.DataFrame
+        The curves, as from ``group_curves()``.
+    out_file : str
+        The file to create.
+
+    Returns
+    -------
+    str
+        The file.
+    """
+    index = curves.index.to_frame(index=False).astype(str)
+    arrays = {f"key_{c}": index[c].to_numpy(dtype=str) for c in index.columns}
+    fd, tmp_file = tempfile.mkstemp(
+        suffix=".tmp", dir=os.path.dirname(os.path.abspath(out_file))
+    )
+    with os.fdopen(fd, "wb") as out:
+        np.savez_compressed(
+            out,
+            counts=curves.to_numpy(dtype=np.int64),
+            thresholds=curves.columns.to_numpy(dtype=float),
+            **arrays,
+        )
+
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def load(curve_file) -> pd.DataFrame:
+    """
+    Load curves saved by ``save()``.
+
+    Parameters
+    ----------
+    curve_file : str
+        The .npz file.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The curves.
+    """
+    with np.load(curve_file) as data:
+        keys = {k[4:]: data[k] for k in data.files if k.startswith("key_")}
+        index = pd.MultiIndex.from_frame(pd.DataFrame(keys))
+        curves = pd.DataFrame(data["counts"], index=index, columns=data["thresholds"])
+
+    curves.columns.name = "threshold"
+    return curves
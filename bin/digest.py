@@ -0,0 +1,299 @@
+"""
+A persistent, memory-mapped index of the peptides in a protein database.
+
+Digesting a FASTA file and grouping its proteins takes minutes for the
+human proteome, and mokapot does it again in every run. Here the result of
+``mokapot.proteins.read_fasta()`` is saved once as sorted numpy arrays,
+keyed on the checksum of the FASTA files and the digest parameters. Later
+runs, in any script or process, memory-map the arrays and look peptides up
+by binary search, so the index loads almost instantly and is shared
+through the page cache.
+"""
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import functools
+from collections.abc import Mapping, Set
+
+import mokapot
+import numpy as np
+
+import memo
+
+INDEX_DIR = os.getenv(
+    "DIGEST_INDEX",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "digests"),
+)
+VERSION = 1  # Increment when the format of the index changes.
+
+
+def fasta_proteins(
+    fasta_files,
+    enzyme="[KR]",
+    missed_cleavages=2,
+    clip_nterm_methionine=False,
+    min_length=6,
+    max_length=50,
+    semi=False,
+    decoy_prefix="decoy_",
+    index_dir=None,
+):
+    """
+    Digest a protein database, using its saved index if there is one.
+
+    This is a drop-in replacement for ``mokapot.FastaProteins()``.
+
+    Parameters
+    ----------
+    fasta_files : str or list of str
+        The FASTA files.
+    enzyme : str
+        A regular expression matching the cleavage sites, as in mokapot.
+    missed_cleavages : int
+        The allowed number of missed cleavages.
+    clip_nterm_methionine : bool
+        Remove methionine residues that occur at the protein N-terminus?
+    min_length : int
+        The minimum peptide length.
+    max_length : int
+        The maximum peptide length.
+    semi : bool
+        Was a semi-enzymatic digest used?
+    decoy_prefix : str
+        The prefix of decoy proteins.
+    index_dir : str, optional
+        The directory of indices. By default, this is ``INDEX_DIR``, which
+        can be set with the ``DIGEST_INDEX`` environment variable.
+
+    Returns
+    -------
+    IndexedProteins
+        The peptides and proteins of the database.
+    """
+    if isinstance(fasta_files, str):
+        fasta_files = [fasta_files]
+
+    params = {
+        "enzyme": enzyme,
+        "missed_cleavages": missed_cleavages,
+        "clip_nterm_methionine": clip_nterm_methionine,
+        "min_length": min_length,
+        "max_length": max_length,
+        "semi": semi,
+        "decoy_prefix": decoy_prefix,
+    }
+
+    if index_dir is None:
+        index_dir = INDEX_DIR
+
+    os.makedirs(index_dir, exist_ok=True)
+    checksums = [_checksum(f) for f in fasta_files]
+    key = json.dumps(
+        {"fasta": checksums, "params": params, "version": VERSION}, sort_keys=True
+    )
+    index_path = os.path.join(index_dir, hashlib.sha256(key.encode()).hexdigest())
+
+    # Wait for any other process that is building the same index.
+    with open(index_path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isdir(index_path):
+            build_index(fasta_files, index_path, **params)
+
+    return IndexedProteins(index_path)
+
+
+def build_index(fasta_files, index_path, **kwargs) -> str:
+    """
+    Digest a protein database and save the index.
+
+    Parameters
+    ----------
+    fasta_files : str or list of str
+        The FASTA files.
+    index_path : str
+        The index directory to create.
+    **kwargs : dict
+        The digest parameters passed to ``mokapot.proteins.read_fasta()``.
+
+    Returns
+    -------
+    str
+        The index directory.
+    """
+    logging.info("Building the digestion index of %s...", fasta_files)
+    enzyme = kwargs.pop("enzyme", "[KR]")
+    peptides, shared, decoys, has_decoys = mokapot.proteins.read_fasta(
+        fasta_files, enzyme_regex=enzyme, **kwargs
+    )
+
+    # Write to a temporary directory, so that partial indices are never used.
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(index_path))
+    try:
+        groups = np.array(list(peptides.values()), dtype=str)
+        groups, group_idx = np.unique(groups, return_inverse=True)
+        _save_map(tmp_dir, "peptides", list(peptides.keys()), group_idx, groups)
+        _save_map(tmp_dir, "decoys", list(decoys.keys()), list(decoys.values()))
+        np.save(os.path.join(tmp_dir, "shared.npy"), _sorted_bytes(shared))
+        meta = {
+            "fasta": [os.path.abspath(f) for f in fasta_files],
+            "params": dict(enzyme=enzyme, **kwargs),
+            "has_decoys": has_decoys,
+            "num_peptides": len(peptides),
+            "num_groups": len(groups),
+        }
+        with open(os.path.join(tmp_dir, "index.json"), "w") as out:
+            json.dump(meta, out, indent=1)
+
+        os.chmod(tmp_dir, 0o755)
+        os.rename(tmp_dir, index_path)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return index_path
+
+
+class IndexedProteins(mokapot.FastaProteins):
+    """
+    The peptides and proteins of a saved digestion index.
+
+    The attributes are those of ``mokapot.FastaProteins``, so this can be
+    passed to ``add_proteins()`` of a mokapot dataset. The mappings are
+    backed by memory-mapped arrays rather than dictionaries.
+
+    Parameters
+    ----------
+    index_path : str
+        The index directory, as created by ``build_index()``.
+    """
+
+    def __init__(self, index_path):
+        """Initialize IndexedProteins"""
+        with open(os.path.join(index_path, "index.json")) as meta:
+            self.meta = json.load(meta)
+
+        groups = _load(index_path, "peptides.values")
+        self._decoy_prefix = self.meta["params"]["decoy_prefix"]
+        self._has_decoys = self.meta["has_decoys"]
+        self._peptide_map = SortedMap(
+            _load(index_path, "peptides.keys"),
+            _load(index_path, "peptides.groups"),
+            groups,
+        )
+        self._protein_map = SortedMap(
+            _load(index_path, "decoys.keys"), _load(index_path, "decoys.values")
+        )
+        self._shared_peptides = SortedSet(_load(index_path, "shared"))
+
+
+class _SortedKeys:
+    """Strings stored as a sorted array of bytes"""
+
+    def __init__(self, keys):
+        """Initialize the keys"""
+        self._keys = keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return (k.decode() for k in self._keys)
+
+    def _find(self, key):
+        """The position of a key in the array, or None if it is missing"""
+        if not isinstance(key, str) or not self._keys.size:
+            return None
+
+        key = key.encode()
+        idx = np.searchsorted(self._keys, key)
+        if idx < len(self._keys) and self._keys[idx] == key:
+            return idx
+
+        return None
+
+
+class SortedSet(_SortedKeys, Set):
+    """
+    A read-only set of strings stored as a sorted array of bytes.
+
+    Parameters
+    ----------
+    keys : numpy.ndarray
+        The sorted, ASCII encoded strings.
+    """
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+
+class SortedMap(_SortedKeys, Mapping):
+    """
+    A read-only mapping of strings stored as sorted arrays of bytes.
+
+    Parameters
+    ----------
+    keys : numpy.ndarray
+        The sorted, ASCII encoded keys.
+    values : numpy.ndarray
+        The encoded value of each key or, if ``table`` is given, the
+        position of its value in the table.
+    table : numpy.ndarray, optional
+        The distinct encoded values.
+    """
+
+    def __init__(self, keys, values, table=None):
+        """Initialize a SortedMap"""
+        super().__init__(keys)
+        self._values = values
+        self._table = table
+
+    def __getitem__(self, key):
+        idx = self._find(key)
+        if idx is None:
+            raise KeyError(key)
+
+        value = self._values[idx]
+        if self._table is not None:
+            value = self._table[value]
+
+        return value.decode()
+
+
+def _checksum(fasta_file):
+    """The checksum of a FASTA file, calculated once per process"""
+    info = os.stat(fasta_file)
+    return _file_checksum(os.path.abspath(fasta_file), info.st_size, info.st_mtime_ns)
+
+
+@functools.lru_cache()
+def _file_checksum(path, size, mtime_ns):
+    """The checksum of a file, as of its size and modification time"""
+    return memo.checksum(path)
+
+
+def _sorted_bytes(strings):
+    """Encode and sort strings into an array of bytes"""
+    return np.sort(np.array([s.encode() for s in strings], dtype=bytes))
+
+
+def _save_map(out_dir, name, keys, values, table=None):
+    """Save a mapping as sorted arrays"""
+    keys = np.array([k.encode() for k in keys], dtype=bytes)
+    order = np.argsort(keys)
+    np.save(os.path.join(out_dir, f"{name}.keys.npy"), keys[order])
+    if table is None:
+        values = np.array([v.encode() for v in values], dtype=bytes)
+        np.save(os.path.join(out_dir, f"{name}.values.npy"), values[order])
+    else:
+        np.save(os.path.join(out_dir, f"{name}.groups.npy"), values[order])
+        table = np.array([t.encode() for t in table], dtype=bytes)
+        np.save(os.path.join(out_dir, f"{name}.values.npy"), table)
+
+
+def _load(index_path, name):
+    """Memory-map an array of an index"""
+    return np.load(os.path.join(index_path, f"{name}.npy"), mmap_mode="r")
@@ -3,15 +3,46 @@ Download the required proteomics data and fasta files.
 """
 import os
 import sys
+import json
+import time
+import fcntl
+import gzip
+import shlex
+import ftplib
+import hashlib
+import urllib.error
+import urllib.parse
+import urllib.request
 from typing import List
 import ppx
 import logging
 import subprocess
+from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import mzml
 
 DATA_DIR = os.path.abspath(
     os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
 )
 
+# Converting is limited by the disk as much as the CPU, so more than a few
+# converters at once just compete for it.
+MAX_CONVERTERS = 4
+
+MANIFEST = "manifest.json"
+
+# The number of files to download at once, the number of times to resume
+# a failed transfer, and the bytes to read at a time.
+CONNECTIONS = 4
+RETRIES = 5
+CHUNK_SIZE = 2 ** 20
+
+# Dataset listings are cached here and refreshed after a week. Setting the
+# DOWNLOAD_OFFLINE environment variable uses only what is already on disk.
+LISTING_DIR = os.path.join(DATA_DIR, "listings")
+LISTING_TTL = 7 * 24 * 60 * 60
+
 
 def rnaxl(experiment="human") -> List[str]:
     """
@@ -29,8 +60,8 @@ def rnaxl(experiment="human") -> List[str]:
     out_dir = os.path.join(DATA_DIR, "rnaxl", "mzML")
     os.makedirs(out_dir, exist_ok=True)
 
-    dataset = ppx.PXDataset("PXD000513")
-    all_files = [f for f in dataset.list_files() if f.endswith(".mzML")]
+    dataset = _LazyDataset("PXD000513")
+    all_files = [f for f in list_files("PXD000513") if f.endswith(".mzML")]
 
     if experiment == "human":
         mzml_files = [f for f in all_files if "XL_human_RBPs" in f]
@@ -40,8 +71,7 @@ def rnaxl(experiment="human") -> List[str]:
         mzml_files = [f for f in all_files if "XL_yeast_RBPs_invivo_4SU_Ex" in f]
 
     logging.info("Downloading...")
-    downloaded = dataset.download(mzml_files, dest_dir=out_dir)
-    return downloaded
+    return fetch_all(dataset, mzml_files, out_dir)
 
 
 def scope2() -> List[str]:
@@ -58,91 +88,809 @@ def scope2() -> List[str]:
     raw_dir = os.path.join(DATA_DIR, "scope2", "raw")
     mzml_dir = os.path.join(DATA_DIR, "scope2", "mzML")
 
-    os.makedirs(raw_dir, exist_ok=True)
-    os.makedirs(mzml_dir, exist_ok=True)
-
     skip = ["190228S_LCA9_X_FP94BF.raw", "190321S_LCA10_X_FP97BE.raw"]
 
-    dataset = ppx.MSVDataset("MSV000083945")
+    dataset = _LazyDataset("MSV000083945")
     raw_files = [
         f
-        for f in dataset.list_files("raw/scope2_raw")
+        for f in list_files("MSV000083945", "raw/scope2_raw")
         if f.endswith(".raw") and f not in skip
     ]
+    raw_files = ["raw/scope2_raw/" + f for f in raw_files]
+    return download_and_convert(dataset, raw_files, raw_dir, mzml_dir)
+
+
+def list_files(accession, path=None, ttl=LISTING_TTL, refresh=False) -> List[str]:
+    """
+    List the files in a dataset, using a cached listing when possible.
+
+    Listings are saved in ``LISTING_DIR`` and reused until they are older
+    than ``ttl``. If the repository cannot be reached, an expired listing
+    is used instead. When the ``DOWNLOAD_OFFLINE`` environment variable is
+    set, the repository is never contacted.
+
+    Parameters
+    ----------
+    accession : str
+        The ProteomeXchange or MassIVE accession of the dataset.
+    path : str, optional
+        List the files in this directory of the dataset.
+    ttl : float
+        The number of seconds for which a listing is valid.
+    refresh : bool
+        Ignore the cached listing and fetch a new one?
+
+    Returns
+    -------
+    list of str
+        The files in the dataset.
+    """
+    listing_file = os.path.join(LISTING_DIR, f"{accession}.json")
+    key = path if path is not None else ""
+    try:
+        with open(listing_file) as listing:
+            listings = json.load(listing)
+    except FileNotFoundError:
+        listings = {}
+
+    cached = listings.get(key)
+    if cached is not None and offline():
+        return cached["files"]
+
+    if cached is not None and not refresh and time.time() - cached["time"] < ttl:
+        return cached["files"]
+
+    args = [path] if path is not None else []
+    try:
+        files = _LazyDataset(accession).list_files(*args)
+    except Exception as err:
+        if cached is None:
+            raise
+
+        logging.warning(
+            "Could not list the files in %s (%s). Using the listing from %s.",
+            accession,
+            err,
+            time.ctime(cached["time"]),
+        )
+        return cached["files"]
+
+    # Other runs may have added listings in the meantime.
+    os.makedirs(LISTING_DIR, exist_ok=True)
+    with open(listing_file + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(listing_file) as listing:
+                listings = json.load(listing)
+        except FileNotFoundError:
+            listings = {}
+
+        listings[key] = {"time": time.time(), "files": list(files)}
+        tmp_file = f"{listing_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as out:
+            json.dump(listings, out, indent=1)
+
+        os.replace(tmp_file, listing_file)
+
+    return list(files)
+
+
+def offline() -> bool:
+    """Is the DOWNLOAD_OFFLINE environment variable set?"""
+    return os.getenv("DOWNLOAD_OFFLINE", "").lower() not in ("", "0", "false")
+
+
+def download_and_convert(
+    dataset,
+    raw_files,
+    raw_dir,
+    mzml_dir,
+    workers=None,
+    batch_size=1,
+    parser=None,
+    connections=CONNECTIONS,
+    seekable=False,
+) -> List[str]:
+    """
+    Download raw files and convert each one to mzML as soon as it arrives.
+
+    Files are downloaded concurrently while a bounded pool of converters
+    works through the files that have already arrived, so the network and
+    the CPU are busy at the same time. Only files whose mzML file is
+    missing or does not match the manifest in ``mzml_dir`` are converted,
+    and raw files are only downloaded again if they are missing or do not
+    match the manifest in ``raw_dir``.
+
+    Parameters
+    ----------
+    dataset : ppx.PXDataset or ppx.MSVDataset
+        The dataset to download from.
+    raw_files : list of str
+        The raw files to download, as listed by the dataset.
+    raw_dir : str
+        The destination directory for raw files.
+    mzml_dir : str
+        The destination directory for mzML files.
+    workers : int, optional
+        The maximum number of converters to run at once. By default, this
+        is the number of cores available, up to ``MAX_CONVERTERS``.
+    batch_size : int
+        The number of raw files to convert with each converter process.
+        Larger batches pay the startup cost of the converter less often.
+    parser : list of str, optional
+        The command to run ThermoRawFileParser. See ``convert()``.
+    connections : int
+        The maximum number of files to download at once.
+    seekable : bool
+        Compress the mzML files in blocks and index their spectra. See
+        ``convert()``.
+
+    Returns
+    -------
+    A list of gzipped mzML files.
+    """
+    os.makedirs(raw_dir, exist_ok=True)
+    os.makedirs(mzml_dir, exist_ok=True)
+    if workers is None:
+        workers = min(len(os.sched_getaffinity(0)), MAX_CONVERTERS)
+
     out_files = [
-        os.path.join(mzml_dir, f.replace(".raw", ".mzML.gz")) for f in raw_files
+        os.path.join(mzml_dir, os.path.basename(f).replace(".raw", ".mzML.gz"))
+        for f in raw_files
     ]
 
-    raw_files = ["raw/scope2_raw/" + f for f in raw_files]
-
-    if not all([os.path.isfile(f) for f in out_files]):
-        logging.info("Downloading...")
-        downloaded = dataset.download(raw_files, dest_dir=raw_dir)
-        logging.info("Converting...")
-        for raw_file in downloaded:
-            _ = convert(raw_file, mzml_dir, gzip=True)
+    raw_manifest = Manifest(raw_dir)
+    mzml_manifest = Manifest(mzml_dir)
+    missing = [r for r, o in zip(raw_files, out_files) if not mzml_manifest.valid(o)]
+    if not missing:
+        return out_files
+
+    logging.info("Downloading and converting %i raw files...", len(missing))
+    batches = []
+    with ThreadPoolExecutor(connections) as downloads, ThreadPoolExecutor(
+        workers
+    ) as pool:
+        fetched = [
+            downloads.submit(fetch, dataset, r, raw_dir, raw_manifest) for r in missing
+        ]
+
+        try:
+            batch = []
+            for idx, raw_file in enumerate(as_completed(fetched)):
+                batch.append(raw_file.result())
+                if len(batch) < batch_size and idx < len(missing) - 1:
+                    continue
+
+                logging.info("Converting %s...", ", ".join(batch))
+                batches.append(
+                    pool.submit(
+                        _convert, batch, mzml_dir, mzml_manifest, parser, seekable
+                    )
+                )
+                batch = []
+
+                # Stop downloading if a conversion has already failed.
+                failed = [b for b in batches if b.done() and b.exception()]
+                if failed:
+                    failed[0].result()
+
+            for converted in batches:
+                converted.result()
+        except BaseException:
+            for future in fetched + batches:
+                future.cancel()
+
+            raise
 
     return out_files
 
 
-def convert(raw, dest_dir=".", gzip=False):
+def fetch_all(dataset, remote_files, dest_dir, connections=CONNECTIONS) -> List[str]:
     """
-    Convert raw files to mzML format
+    Download files concurrently, unless valid copies already exist.
 
     Parameters
     ----------
-    raw : str
-        The raw file to convert.
+    dataset : ppx.PXDataset or ppx.MSVDataset
+        The dataset to download from.
+    remote_files : list of str
+        The files to download, as listed by the dataset.
+    dest_dir : str
+        The destination directory.
+    connections : int
+        The maximum number of files to download at once.
+
+    Returns
+    -------
+    list of str
+        The downloaded files, in the same order.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    manifest = Manifest(dest_dir)
+    with ThreadPoolExecutor(connections) as downloads:
+        fetched = [
+            downloads.submit(fetch, dataset, f, dest_dir, manifest)
+            for f in remote_files
+        ]
+
+        try:
+            return [f.result() for f in fetched]
+        except BaseException:
+            for future in fetched:
+                future.cancel()
+
+            raise
+
 
+def fetch(dataset, remote_file, dest_dir, manifest=None) -> str:
+    """
+    Download a single file, unless a valid copy already exists.
+
+    If the dataset has a URL, the file is transferred with ``transfer()``,
+    resuming any partial download. Otherwise, ppx downloads the file to a
+    temporary directory. Either way, an interrupted download never leaves
+    a partial file in place of the complete one.
+
+    Parameters
+    ----------
+    dataset : ppx.PXDataset or ppx.MSVDataset
+        The dataset to download from.
+    remote_file : str
+        The file to download, as listed by the dataset.
     dest_dir : str
-        The destination directory for output.
+        The destination directory.
+    manifest : Manifest, optional
+        The manifest of the destination directory. By default, it is
+        loaded from the destination directory.
 
     Returns
     -------
     str
-        The mzML file.
+        The downloaded file.
     """
-    ex_path = os.path.join(os.path.dirname(sys.executable), "ThermoRawFileParser.exe")
+    if manifest is None:
+        manifest = Manifest(dest_dir)
 
-    ext = ".mzML"
-    cmd = ["mono", ex_path, "-i=" + raw, "-o=" + dest_dir, "-f=2", "-m=1"]
+    out_file = os.path.join(dest_dir, os.path.basename(remote_file))
+    if manifest.valid(out_file):
+        return out_file
 
-    if gzip:
-        cmd += ["-g"]
-        ext += ".gz"
+    # Files from before the manifest existed may be incomplete.
+    unknown = os.path.isfile(out_file)
+    unknown &= os.path.basename(out_file) not in manifest.load()
+    if unknown and offline():
+        logging.warning("%s is not in the manifest. Using it anyway.", out_file)
+        return out_file
 
-    out_file = os.path.join(dest_dir, os.path.split(raw)[-1].replace(".raw", ext))
-    if not os.path.isfile(out_file):
-        subprocess.run(cmd, check=True)
+    if offline():
+        raise RuntimeError(f"{out_file} is missing, but DOWNLOAD_OFFLINE is set.")
+
+    url = getattr(dataset, "url", None)
+    if url is not None:
+        if unknown and not os.path.exists(out_file + ".part"):
+            os.replace(out_file, out_file + ".part")  # Resume it.
+
+        transfer(url.rstrip("/") + "/" + remote_file, out_file, manifest=manifest)
+    else:
+        with TemporaryDirectory(dir=dest_dir) as tmp:
+            downloaded = dataset.download([remote_file], dest_dir=tmp)[0]
+            os.replace(downloaded, out_file)
+
+        manifest.add(out_file)
 
-    assert os.path.isfile(out_file)  # verify that it is actually there!
     return out_file
 
 
-def _download_and_convert(dataset, out_dir, raw_files=None):
-    """Do the download and conversion"""
-    raw_dir = os.path.join(out_dir, "raw")
-    mzml_dir = os.path.join(out_dir, "mzML")
+def transfer(
+    url,
+    out_file,
+    retries=RETRIES,
+    chunk_size=CHUNK_SIZE,
+    timeout=60,
+    manifest=None,
+) -> dict:
+    """
+    Download a URL to a file, resuming a partial download if there is one.
 
-    os.makedirs(raw_dir, exist_ok=True)
-    os.makedirs(mzml_dir, exist_ok=True)
+    The data are written to ``{out_file}.part``, which is renamed once the
+    transfer is complete. A failed transfer is retried from the byte where
+    it stopped, as is a partial file left by an earlier run. The partial
+    file is locked during the transfer, so concurrent runs wait for each
+    other rather than writing to it at the same time. A run that was
+    waiting keeps the file that the other run downloaded.
 
-    if raw_files is None:
-        raw_files = [f for f in dataset.list_files() if f.endswith(".raw")]
+    Parameters
+    ----------
+    url : str
+        The URL to download. FTP, HTTP(S), and file URLs are supported.
+    out_file : str
+        The file to create.
+    retries : int
+        The number of times to resume a failed transfer.
+    chunk_size : int
+        The number of bytes to read at a time.
+    timeout : float
+        The number of seconds to wait for the server to respond.
+    manifest : Manifest, optional
+        The manifest of the destination directory. If given, the file is
+        recorded in it before the lock is released, and a valid file that
+        is already recorded is not downloaded again.
+
+    Returns
+    -------
+    dict
+        The URL, the file, the number of bytes transferred, the size of
+        the partial file it was resumed from, the number of seconds it
+        took, and the throughput in MB/s.
+    """
+    part_file = out_file + ".part"
+    with open(part_file, "ab") as part:
+        fcntl.flock(part, fcntl.LOCK_EX)
+        if _transferred(part, part_file, out_file, manifest):
+            logging.info("%s was downloaded by another run.", out_file)
+            return {
+                "url": url,
+                "file": out_file,
+                "bytes": 0,
+                "resumed": 0,
+                "seconds": 0.0,
+                "throughput": float("nan"),
+            }
+
+        resumed = part.tell()
+        received = [0]
+
+        def write(chunk):
+            part.write(chunk)
+            received[0] += len(chunk)
+
+        start = time.time()
+        for attempt in range(retries + 1):
+            try:
+                if urllib.parse.urlparse(url).scheme == "ftp":
+                    size = _transfer_ftp(url, part, write, chunk_size, timeout)
+                else:
+                    size = _transfer_url(url, part, write, chunk_size, timeout)
+
+                part.flush()
+                if size is not None and part.tell() != size:
+                    raise OSError(f"Expected {size} bytes but received {part.tell()}")
+
+                break
+            except (OSError, ftplib.Error) as err:
+                if attempt == retries:
+                    raise
+
+                logging.warning(
+                    "Transfer of %s failed (%s). Resuming from byte %i...",
+                    url,
+                    err,
+                    part.tell(),
+                )
+                time.sleep(2 ** attempt)
+
+        os.replace(part_file, out_file)
+        if manifest is not None:
+            manifest.add(out_file)
+
+        elapsed = time.time() - start
+        received = received[0]
+
+    stats = {
+        "url": url,
+        "file": out_file,
+        "bytes": received,
+        "resumed": resumed,
+        "seconds": elapsed,
+        "throughput": received / 1e6 / elapsed if elapsed else float("nan"),
+    }
+    logging.info(
+        "Downloaded %s: %.1f MB in %.1f s (%.1f MB/s)",
+        os.path.basename(out_file),
+        received / 1e6,
+        elapsed,
+        stats["throughput"],
+    )
+    return stats
+
+
+def convert(
+    raw, dest_dir=".", gzip=False, parser=None, overwrite=False, seekable=False
+):
+    """
+    Convert raw files to mzML format
+
+    Parameters
+    ----------
+    raw : str or list of str
+        The raw file to convert. If multiple raw files are given, they are
+        all converted by a single ThermoRawFileParser process.
+
+    dest_dir : str
+        The destination directory for output.
+
+    parser : list of str, optional
+        The command to run ThermoRawFileParser. By default, this is the
+        ``RAW_FILE_PARSER`` environment variable or, if that is unset,
+        ``mono ThermoRawFileParser.exe`` from the current environment.
+
+    overwrite : bool
+        Convert raw files even if their mzML file already exists?
+
+    seekable : bool
+        Compress the mzML files in blocks and index their spectra, so that
+        individual spectra can be read with ``mzml.SpectrumReader``. The
+        files are still gzipped, so ``gzip`` is implied.
+
+    Returns
+    -------
+    str or list of str
+        The mzML file or files.
+    """
+    if parser is None:
+        parser = os.getenv("RAW_FILE_PARSER")
+        if parser:
+            parser = shlex.split(parser)
+        else:
+            ex_path = os.path.join(
+                os.path.dirname(sys.executable), "ThermoRawFileParser.exe"
+            )
+            parser = ["mono", ex_path]
+
+    raw_files = [raw] if isinstance(raw, str) else list(raw)
+
+    ext = ".mzML"
+    args = ["-f=2", "-m=1"]
+
+    if gzip and not seekable:
+        args += ["-g"]
+
+    if gzip or seekable:
+        ext += ".gz"
 
     out_files = [
-        os.path.join(mzml_dir, f.replace(".raw", ".mzML.gz")) for f in raw_files
+        os.path.join(dest_dir, os.path.split(r)[-1].replace(".raw", ext))
+        for r in raw_files
     ]
 
-    out_files = [
-        os.path.join(mzml_dir, f.replace(".raw", ".mzML.gz")) for f in raw_files
+    todo = [
+        r for r, o in zip(raw_files, out_files) if overwrite or not os.path.isfile(o)
     ]
+    if todo:
+        # Convert into a temporary directory and then rename, so that an
+        # interrupted conversion never leaves a partial mzML file behind.
+        with TemporaryDirectory(dir=dest_dir) as tmp:
+            args = ["-o=" + tmp] + args
+            if len(todo) == 1:
+                subprocess.run(parser + ["-i=" + todo[0]] + args, check=True)
+            else:
+                # The parser converts every raw file in a directory, so link
+                # the ones to convert into a directory of their own.
+                in_dir = os.path.join(tmp, "raw")
+                os.mkdir(in_dir)
+                for raw_file in todo:
+                    link = os.path.join(in_dir, os.path.basename(raw_file))
+                    os.symlink(os.path.abspath(raw_file), link)
+
+                subprocess.run(parser + ["-d=" + in_dir] + args, check=True)
+
+            for raw_file in todo:
+                name = os.path.basename(raw_file).replace(".raw", ext)
+                if seekable:
+                    mzml_file = os.path.join(tmp, name[:-3])
+                    mzml.compress(mzml_file, os.path.join(tmp, name))
+                    os.replace(
+                        mzml.index_file(os.path.join(tmp, name)),
+                        mzml.index_file(os.path.join(dest_dir, name)),
+                    )
+
+                os.replace(os.path.join(tmp, name), os.path.join(dest_dir, name))
+
+    for out_file in out_files:
+        assert os.path.isfile(out_file)  # verify that it is actually there!
+
+    if isinstance(raw, str):
+        return out_files[0]
+
+    return out_files
+
+
+class _LazyDataset:
+    """
+    A ppx dataset that is only created when it is used.
+
+    Creating a dataset may contact the repository, which is unnecessary
+    when every file is already on disk and impossible when offline.
+    """
+
+    def __init__(self, accession):
+        """Initialize a _LazyDataset"""
+        self.accession = accession
+        self._dataset = None
+
+    def __getattr__(self, name):
+        """Get an attribute of the ppx dataset, creating it if needed"""
+        if name.startswith("_"):
+            raise AttributeError(name)
 
-    if not all([os.path.isfile(f) for f in out_files]):
-        logging.info("Downloading...")
-        downloaded = dataset.download(raw_files, dest_dir=raw_dir)
-        logging.info("Converting...")
-        for raw_file in downloaded:
-            _ = convert(raw_file, mzml_dir, gzip=True)
+        if offline():
+            raise RuntimeError(
+                f"{self.accession} is needed, but DOWNLOAD_OFFLINE is set."
+            )
+
+        if self._dataset is None:
+            if self.accession.startswith("MSV"):
+                self._dataset = ppx.MSVDataset(self.accession)
+            else:
+                self._dataset = ppx.PXDataset(self.accession)
+
+        return getattr(self._dataset, name)
+
+
+class Manifest:
+    """
+    The sizes and checksums of the files in a directory.
+
+    A file is only trusted if it matches its entry in the manifest, so
+    missing and corrupt files can be replaced individually. The manifest
+    is locked while it is updated, so several processes can share it.
+
+    Parameters
+    ----------
+    directory : str
+        The directory. The manifest is saved in it as ``manifest.json``.
+    """
+
+    def __init__(self, directory):
+        """Initialize a Manifest"""
+        self.directory = directory
+        self.manifest_file = os.path.join(directory, MANIFEST)
+
+    def valid(self, path) -> bool:
+        """
+        Is a file complete and unchanged since it was recorded?
+
+        The checksum is only recalculated if the modification time of the
+        file has changed. Gzipped files that are not in the manifest, such
+        as those from before it existed, are recorded if they can be
+        decompressed in full.
+
+        Parameters
+        ----------
+        path : str
+            The file to check.
+
+        Returns
+        -------
+        bool
+            True if the file can be used.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+
+        entry = self.load().get(os.path.basename(path))
+        if entry is None:
+            if path.endswith(".gz") and _gzip_intact(path):
+                self.add(path)
+                return True
+
+            return False
+
+        if stat.st_size != entry["size"]:
+            logging.warning("%s is the wrong size.", path)
+            return False
+
+        if stat.st_mtime_ns == entry["mtime_ns"]:
+            return True
+
+        if checksum(path) != entry["sha256"]:
+            logging.warning("%s does not match its checksum.", path)
+            return False
+
+        return True
+
+    def add(self, path):
+        """
+        Record the size and checksum of a file.
+
+        Parameters
+        ----------
+        path : str
+            The file to record.
+        """
+        stat = os.stat(path)
+        entry = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": checksum(path),
+        }
+
+        with open(self.manifest_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self.load()
+            entries[os.path.basename(path)] = entry
+            tmp_file = f"{self.manifest_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as out:
+                json.dump(entries, out, indent=1, sort_keys=True)
+
+            os.replace(tmp_file, self.manifest_file)
+
+    def load(self) -> dict:
+        """
+        Load the entries of the manifest.
+
+        Returns
+        -------
+        dict of str, dict
+            The size, modification time, and SHA-256 checksum of each file.
+        """
+        try:
+            with open(self.manifest_file) as entries:
+                return json.load(entries)
+        except FileNotFoundError:
+            return {}
+
+
+def checksum(path, chunk_size=2 ** 20) -> str:
+    """
+    Calculate the SHA-256 checksum of a file.
+
+    Parameters
+    ----------
+    path : str
+        The file.
+    chunk_size : int
+        The number of bytes to read at a time.
+
+    Returns
+    -------
+    str
+        The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as data:
+        for chunk in iter(lambda: data.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _gzip_intact(path, chunk_size=2 ** 20):
+    """Can a gzipped file be decompressed to the end?"""
+    try:
+        with gzip.open(path, "rb") as data:
+            while data.read(chunk_size):
+                pass
+    except (OSError, EOFError):
+        return False
+
+    return True
+
+
+def _convert(raw_files, mzml_dir, manifest, parser, seekable):
+    """Convert raw files to gzipped mzML files and record them"""
+    out_files = convert(
+        raw_files,
+        mzml_dir,
+        gzip=True,
+        parser=parser,
+        overwrite=True,
+        seekable=seekable,
+    )
+    for out_file in out_files:
+        manifest.add(out_file)
 
     return out_files
+
+
+def _transfer_url(url, part, write, chunk_size, timeout):
+    """Append the rest of an HTTP(S) or file URL, returning its full size"""
+    offset = part.tell()
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as err:
+        if err.code != 416:
+            raise
+
+        # The range starts at or past the end of the remote file.
+        size = _content_range_size(err.headers.get("Content-Range"))
+        if size == offset:
+            return size
+
+        logging.warning(
+            "The partial download of %s does not match the remote file. "
+            "Starting again...",
+            url,
+        )
+        part.seek(0)
+        part.truncate()
+        return _transfer_url(url, part, write, chunk_size, timeout)
+
+    with response:
+        if getattr(response, "status", None) != 206:
+            part.seek(0)  # The server ignored the range, so start again.
+            part.truncate()
+
+        length = response.headers.get("Content-Length")
+        size = int(length) + part.tell() if length is not None else None
+        for chunk in iter(lambda: response.read(chunk_size), b""):
+            write(chunk)
+
+    return size
+
+
+def _content_range_size(content_range):
+    """The full size from a Content-Range header, such as 'bytes */1234'"""
+    try:
+        return int(content_range.rsplit("/", 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def _transferred(part, part_file, out_file, manifest):
+    """Did another run finish the download while this one waited for it?"""
+    if not os.path.isfile(out_file):
+        return False
+
+    try:
+        renamed = os.fstat(part.fileno()).st_ino != os.stat(part_file).st_ino
+    except FileNotFoundError:
+        renamed = True
+
+    if renamed:
+        return True
+
+    if manifest is None or not manifest.valid(out_file):
+        return False
+
+    # This run opened a new partial file after the other one finished.
+    if not part.tell():
+        os.remove(part_file)
+
+    return True
+
+
+def _transfer_ftp(url, part, write, chunk_size, timeout):
+    """Append the rest of an FTP URL, returning its full size"""
+    url = urllib.parse.urlparse(url)
+    path = urllib.parse.unquote(url.path)
+    with ftplib.FTP(timeout=timeout) as ftp:
+        ftp.connect(url.hostname, url.port or 21)
+        ftp.login(url.username or "anonymous", url.password or "")
+        ftp.voidcmd("TYPE I")
+        size = ftp.size(path)
+        if size is not None and part.tell() > size:
+            logging.warning(
+                "The partial download of %s is larger than the remote file. "
+                "Starting again...",
+                path,
+            )
+            part.seek(0)
+            part.truncate()
+
+        if size is None or part.tell() < size:
+            ftp.retrbinary(
+                f"RETR {path}",
+                write,
+                blocksize=chunk_size,
+                rest=part.tell() or None,
+            )
+
+    return size
+
+
+def _download_and_convert(dataset, out_dir, raw_files=None):
+    """Do the download and conversion"""
+    raw_dir = os.path.join(out_dir, "raw")
+    mzml_dir = os.path.join(out_dir, "mzML")
+
+    if raw_files is None:
+        raw_files = [f for f in dataset.list_files() if f.endswith(".raw")]
+
+    return download_and_convert(dataset, raw_files, raw_dir, mzml_dir)
@@ -0,0 +1,612 @@
+"""
+Read FASTA files and generate decoy protein databases.
+
+Proteins are parsed in chunks, so databases of any size can be processed
+with constant memory. Decoys are made by reversing or shuffling each
+enzymatic peptide while keeping its cleavage site in place, so the decoy
+peptides have the same masses, lengths, and termini as the targets.
+
+For random access, FASTA files are indexed in the ``.fai`` format of
+``samtools faidx``: the ID, length, and offset of each sequence and the
+length of its lines. An ``IndexedFasta`` memory-maps the file and uses the
+index to find any protein or region with a single seek. Decoys are made
+from indexed files when possible, so each worker reads its own proteins
+from the shared map rather than receiving them from the parent process.
+"""
+import os
+import re
+import mmap
+import random
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+CHUNK_SIZE = 10000
+LINE_WIDTH = 60
+FAI_EXT = ".fai"
+FAI_COLUMNS = ["name", "length", "offset", "line_bases", "line_width"]
+
+# Regular expressions matching the cleavage sites of each enzyme.
+ENZYMES = {
+    "trypsin": r"(?<=[KR])(?!P)",
+    "trypsin/p": r"(?<=[KR])",
+    "lys-c": r"(?<=K)(?!P)",
+    "lys-n": r"(?=K)",
+    "arg-c": r"(?<=R)(?!P)",
+    "asp-n": r"(?=[DN])",
+    "chymotrypsin": r"(?<=[FWYL])(?!P)",
+    "glu-c": r"(?<=[DE])(?!P)",
+    "no-enzyme": None,
+}
+
+
+def read_fasta(fasta_file, chunk_size=CHUNK_SIZE):
+    """
+    Read the proteins in a FASTA file, a chunk at a time.
+
+    Parameters
+    ----------
+    fasta_file : str
+        The FASTA file.
+    chunk_size : int
+        The number of proteins in each chunk.
+
+    Yields
+    ------
+    list of tuple of (str, str)
+        The header, without the ">", and the sequence of each protein.
+    """
+    chunk = []
+    header = None
+    seq = []
+    with open(fasta_file) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                if header is not None:
+                    chunk.append((header, "".join(seq)))
+                    if len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = []
+
+                header = line[1:].rstrip()
+                seq = []
+            elif header is not None:
+                seq.append(line.strip())
+
+    if header is not None:
+        chunk.append((header, "".join(seq)))
+
+    if chunk:
+        yield chunk
+
+
+def cleave(sequence, enzyme="trypsin") -> list:
+    """
+    Split a protein sequence at every cleavage site of an enzyme.
+
+    Parameters
+    ----------
+    sequence : str
+        The protein sequence.
+    enzyme : str
+        The enzyme, one of ``ENZYMES`` or a regular expression matching
+        its cleavage sites. "no-enzyme" leaves the protein whole.
+
+    Returns
+    -------
+    list of str
+        The fully cleaved peptides, in order.
+    """
+    pattern = ENZYMES.get(enzyme, enzyme)
+    if pattern is None:
+        return [sequence]
+
+    return [p for p in re.split(pattern, sequence) if p]
+
+
+def decoy_sequence(sequence, method="reverse", enzyme="trypsin", rng=None) -> str:
+    """
+    Make the decoy of a protein sequence.
+
+    Each peptide is reversed or shuffled, except for the residue at its
+    cleavage site: the C-terminal residue for enzymes that cleave after a
+    residue and the N-terminal residue for those that cleave before one.
+
+    Parameters
+    ----------
+    sequence : str
+        The protein sequence.
+    method : {"reverse", "shuffle"}
+        How to make the decoy.
+    enzyme : str
+        The enzyme. See ``cleave()``.
+    rng : random.Random, optional
+        The random number generator for shuffling. By default, it is
+        seeded with the sequence, so that the decoy is reproducible.
+
+    Returns
+    -------
+    str
+        The decoy sequence.
+    """
+    if method not in ("reverse", "shuffle"):
+        raise ValueError("method must be 'reverse' or 'shuffle'.")
+
+    if rng is None:
+        rng = random.Random(sequence)
+
+    pattern = ENZYMES.get(enzyme, enzyme)
+    n_term = pattern is not None and pattern.startswith("(?=")
+    decoy = []
+    for pep in cleave(sequence, enzyme):
+        if pattern is None:
+            fixed, core, end = "", pep, ""
+        elif n_term:
+            fixed, core, end = pep[:1], pep[1:], ""
+        else:
+            fixed, core, end = "", pep[:-1], pep[-1:]
+
+        if method == "reverse":
+            core = core[::-1]
+        else:
+            residues = list(core)
+            for _ in range(10):  # Try not to recreate the target.
+                rng.shuffle(residues)
+                if "".join(residues) != core or len(set(core)) < 2:
+                    break
+
+            core = "".join(residues)
+
+        decoy.append(fixed + core + end)
+
+    return "".join(decoy)
+
+
+def make_decoys(
+    fasta_file,
+    out_file,
+    concat=True,
+    method="reverse",
+    enzyme="trypsin",
+    decoy_prefix="decoy_",
+    workers=None,
+    chunk_size=CHUNK_SIZE,
+    seed=42,
+    cpus=None,
+) -> str:
+    """
+    Write a target-decoy protein database in a single pass.
+
+    Chunks of proteins are turned into decoys in a pool of processes,
+    while the targets and decoys of earlier chunks are written. Only a few
+    chunks are in memory at once. If the FASTA file can be indexed, each
+    worker reads its chunks through an ``IndexedFasta``. Otherwise, the
+    proteins are parsed here and sent to the workers.
+
+    Parameters
+    ----------
+    fasta_file : str
+        The target FASTA file.
+    out_file : str
+        The FASTA file to create.
+    concat : bool
+        Write the targets as well as the decoys?
+    method : {"reverse", "shuffle"}
+        How to make the decoys.
+    enzyme : str
+        The enzyme. See ``cleave()``.
+    decoy_prefix : str
+        The prefix added to the protein ID of decoys.
+    workers : int, optional
+        The number of processes. By default, this is the number of cores
+        available.
+    chunk_size : int
+        The number of proteins processed at a time.
+    seed : int
+        The random seed for shuffling. Each protein is shuffled with its
+        own generator, so the decoys do not depend on the chunks.
+    cpus : list of int, optional
+        The cores to which the processes are restricted.
+
+    Returns
+    -------
+    str
+        The target-decoy FASTA file.
+    """
+    if workers is None:
+        workers = len(cpus) if cpus is not None else len(os.sched_getaffinity(0))
+
+    try:
+        if _is_stale(index_file(fasta_file), fasta_file):
+            index_fasta(fasta_file)
+
+        indexed = True
+    except (ValueError, UnicodeDecodeError) as err:
+        logging.warning("Reading %s without an index (%s).", fasta_file, err)
+        indexed = False
+
+    logging.info("Writing targets and decoys from %s to %s...", fasta_file, out_file)
+    args = (method, enzyme, decoy_prefix, seed, concat)
+    init_args = (fasta_file if indexed else None, cpus)
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=init_args
+    ) as pool, open(out_file, "w") as out:
+        if indexed:
+            with IndexedFasta(fasta_file) as fasta:
+                num_proteins = len(fasta)
+
+            jobs = (
+                pool.submit(_decoy_rows, start, start + chunk_size, *args)
+                for start in range(0, num_proteins, chunk_size)
+            )
+        else:
+            jobs = (
+                pool.submit(_decoy_chunk, chunk, *args)
+                for chunk in read_fasta(fasta_file, chunk_size)
+            )
+
+        pending = deque()
+        for job in jobs:
+            pending.append(job)
+            if len(pending) > 2 * workers:
+                out.write(pending.popleft().result())
+
+        while pending:
+            out.write(pending.popleft().result())
+
+    return out_file
+
+
+_FASTA = None  # The IndexedFasta of each worker process.
+
+
+def _init_worker(fasta_file, cpus):
+    """Open the indexed FASTA file and pin a worker to its cores"""
+    global _FASTA
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+
+    if fasta_file is not None:
+        _FASTA = IndexedFasta(fasta_file)
+
+
+def _decoy_rows(start, stop, *args):
+    """Make the decoys of the proteins in a range of rows of the FASTA file"""
+    return _decoy_chunk(_FASTA.records(start, stop), *args)
+
+
+def _decoy_chunk(chunk, method, enzyme, decoy_prefix, seed, concat):
+    """Make the decoys of a chunk of proteins, as FASTA text"""
+    targets = []
+    decoys = []
+    for header, seq in chunk:
+        rng = random.Random(f"{seed}:{seq}") if method == "shuffle" else None
+        decoys.append((decoy_prefix + header, decoy_sequence(seq, method, enzyme, rng)))
+        if concat:
+            targets.append((header, seq))
+
+    return _format_proteins(targets) + _format_proteins(decoys)
+
+
+def _format_proteins(proteins):
+    """Format proteins as FASTA text"""
+    lines = []
+    for header, seq in proteins:
+        lines.append(">" + header)
+        lines += [seq[i : i + LINE_WIDTH] for i in range(0, len(seq), LINE_WIDTH)]
+
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def index_file(fasta_file) -> str:
+    """
+    The index of a FASTA file.
+
+    Parameters
+    ----------
+    fasta_file : str
+        The FASTA file.
+
+    Returns
+    -------
+    str
+        The index file.
+    """
+    return fasta_file + FAI_EXT
+
+
+def index_fasta(fasta_file) -> str:
+    """
+    Index a FASTA file, as ``samtools faidx`` does.
+
+    Every line of a sequence, except the last, must have the same length.
+    The ID of a sequence is the first word of its header.
+
+    Parameters
+    ----------
+    fasta_file : str
+        The FASTA file, which must not be compressed.
+
+    Returns
+    -------
+    str
+        The index file, as given by ``index_file()``.
+    """
+    logging.info("Indexing %s...", fasta_file)
+    rows = []
+    entry = None
+    pos = 0
+    with open(fasta_file, "rb") as fasta:
+        for line in fasta:
+            pos += len(line)
+            if line.startswith(b">"):
+                if entry is not None:
+                    rows.append(entry[:5])
+
+                name = line[1:].split(None, 1)
+                name = name[0].decode() if name else ""
+                entry = [name, 0, pos, 0, 0, False]  # Plus: was a line short?
+                continue
+
+            bases = len(line.rstrip(b"\r\n"))
+            if entry is None or not bases:
+                continue
+
+            if entry[1] and (entry[5] or bases > entry[3]):
+                raise ValueError(
+                    f"Lines of different lengths in '{entry[0]}' of {fasta_file}."
+                )
+
+            if not entry[1]:
+                entry[3:5] = [bases, len(line)]
+            elif bases < entry[3]:
+                entry[5] = True
+
+            entry[1] += bases
+
+    if entry is not None:
+        rows.append(entry[:5])
+
+    fai_file = index_file(fasta_file)
+    tmp_file = f"{fai_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as fai:
+        for row in rows:
+            fai.write("\t".join(str(x) for x in row) + "\n")
+
+    os.replace(tmp_file, fai_file)
+    return fai_file
+
+
+class IndexedFasta:
+    """
+    Random access to the sequences of a FASTA file.
+
+    The file is memory-mapped and indexed, and the index is created or
+    updated if it is missing or older than the file. Looking up a protein
+    by its ID is a dictionary lookup followed by a slice of the map.
+
+    Parameters
+    ----------
+    fasta_file : str
+        The FASTA file, which must not be compressed.
+
+    Attributes
+    ----------
+    ids : numpy.ndarray
+        The ID of each protein, in the order of the file.
+    lengths : numpy.ndarray
+        The length of each protein.
+    """
+
+    def __init__(self, fasta_file):
+        """Initialize an IndexedFasta"""
+        self.fasta_file = fasta_file
+        fai_file = index_file(fasta_file)
+        if _is_stale(fai_file, fasta_file):
+            index_fasta(fasta_file)
+
+        fai = pd.read_csv(
+            fai_file,
+            sep="\t",
+            header=None,
+            names=FAI_COLUMNS,
+            dtype={"name": str},
+            keep_default_na=False,
+            quoting=3,  # csv.QUOTE_NONE
+        )
+        self.ids = fai["name"].to_numpy()
+        self.lengths = fai["length"].to_numpy()
+        self._offsets = fai["offset"].to_numpy()
+        self._line_bases = fai["line_bases"].to_numpy()
+        self._line_widths = fai["line_width"].to_numpy()
+
+        # As in samtools, the first of any duplicate IDs is used.
+        self._rows = {}
+        for row, name in enumerate(self.ids):
+            self._rows.setdefault(name, row)
+
+        self._file = open(fasta_file, "rb")
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def __getitem__(self, name):
+        return self.fetch(name)
+
+    def close(self):
+        """Close the FASTA file"""
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+        self._file.close()
+
+    def locate(self, names) -> np.ndarray:
+        """
+        Find the rows of many proteins at once.
+
+        Parameters
+        ----------
+        names : array-like of str
+            The protein IDs.
+
+        Returns
+        -------
+        numpy.ndarray
+            The position of each protein in ``ids``, or -1 if it is missing.
+        """
+        rows = pd.Series(names, dtype=object).map(self._rows)
+        return rows.fillna(-1).to_numpy(dtype=np.int64)
+
+    def view(self, name) -> memoryview:
+        """
+        The raw bytes of a sequence, without copying them.
+
+        Parameters
+        ----------
+        name : str
+            The protein ID.
+
+        Returns
+        -------
+        memoryview
+            The lines of the sequence, including their line breaks.
+        """
+        row = self._rows[name]
+        start, end = self._span(row, 0, self.lengths[row])
+        return memoryview(self._map)[start:end]
+
+    def fetch(self, name, start=0, end=None) -> str:
+        """
+        Read a sequence or a region of it.
+
+        Parameters
+        ----------
+        name : str
+            The protein ID.
+        start : int
+            The first position, counting from zero.
+        end : int, optional
+            The position after the last, or the end of the sequence.
+
+        Returns
+        -------
+        str
+            The sequence.
+        """
+        return self._fetch(self._rows[name], start, end)
+
+    def header(self, name) -> str:
+        """
+        The header of a protein, without the ">".
+
+        Parameters
+        ----------
+        name : str
+            The protein ID.
+
+        Returns
+        -------
+        str
+            The header.
+        """
+        return self._header(self._rows[name])
+
+    def records(self, start=0, stop=None):
+        """
+        Read the proteins in a range of rows, in the order of the file.
+
+        Unlike lookups by ID, every protein is read, including those with
+        duplicate IDs.
+
+        Parameters
+        ----------
+        start : int
+            The first row.
+        stop : int, optional
+            The row after the last, or the end of the file.
+
+        Yields
+        ------
+        tuple of (str, str)
+            The header, without the ">", and the sequence of each protein.
+        """
+        for row in range(*slice(start, stop).indices(len(self))):
+            yield self._header(row), self._fetch(row)
+
+    def _fetch(self, row, start=0, end=None):
+        """Read a region of the sequence in a row"""
+        length = self.lengths[row]
+        end = length if end is None else min(end, length)
+        start = max(0, min(start, end))
+        first, last = self._span(row, start, end)
+        seq = self._map[first:last]
+        if end - start != last - first:
+            seq = seq.translate(None, b"\r\n")
+
+        return seq.decode()
+
+    def _header(self, row):
+        """Read the header of the protein in a row"""
+        offset = self._offsets[row]
+        start = self._map.rfind(b"\n", 0, max(offset - 1, 0)) + 2  # Skip the ">".
+        return self._map[start:offset].rstrip(b"\r\n").decode()
+
+    def stats(self) -> dict:
+        """
+        Summarize the lengths of the proteins.
+
+        Returns
+        -------
+        dict
+            The number of proteins, their total, minimum, median, mean, and
+            maximum length, and the number with duplicate IDs.
+        """
+        lengths = self.lengths if len(self) else np.zeros(1, dtype=int)
+        return {
+            "proteins": len(self),
+            "residues": int(self.lengths.sum()),
+            "min_length": int(lengths.min()),
+            "median_length": float(np.median(lengths)),
+            "mean_length": float(lengths.mean()),
+            "max_length": int(lengths.max()),
+            "duplicate_ids": len(self) - len(self._rows),
+        }
+
+    def _span(self, row, start, end):
+        """The byte offsets of a region of a sequence"""
+        offset = self._offsets[row]
+        bases = max(self._line_bases[row], 1)
+        width = self._line_widths[row]
+        first = offset + start // bases * width + start % bases
+        last = offset + end // bases * width + end % bases
+        if end and not end % bases:
+            last -= width - bases  # Exclude the final line break.
+
+        return int(first), int(last)
+
+
+def _is_stale(fai_file, fasta_file):
+    """Is an index missing or older than its FASTA file?"""
+    try:
+        return os.path.getmtime(fai_file) < os.path.getmtime(fasta_file)
+    except FileNotFoundError:
+        return True
@@ -0,0 +1,330 @@
+"""
+Statistics and a persistent history for benchmark results.
+
+Replicate measurements are summarized with a confidence interval so that
+a configuration can be repeated until the estimate is precise enough, and
+outlying runs are flagged. Every run is appended to a SQLite database
+keyed by the host and tool version, against which new runs are compared to
+detect regressions.
+"""
+import re
+import sqlite3
+import logging
+import platform
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+COLUMNS = [
+    "host",
+    "dataset",
+    "tool",
+    "version",
+    "psms",
+    "threads",
+    "rep",
+    "start",
+    "wall_time",
+    "max_rss",
+    "outlier",
+    "profile",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    host TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    tool TEXT NOT NULL,
+    version TEXT,
+    psms INTEGER NOT NULL,
+    threads INTEGER,
+    rep INTEGER,
+    start REAL NOT NULL,
+    wall_time REAL NOT NULL,
+    max_rss REAL NOT NULL,
+    outlier INTEGER NOT NULL,
+    profile TEXT,
+    UNIQUE (host, tool, start)
+)
+"""
+
+# The columns added to existing databases, by the version in which they
+# were added. The version is stored as the user_version of the database,
+# but databases made before it was set may already have some columns.
+SCHEMA_VERSION = 1
+MIGRATIONS = {
+    # Earlier runs were all of the PSMs sampled from Kim et al.
+    1: ("dataset", "TEXT NOT NULL DEFAULT 'sampled'"),
+}
+
+
+def ci_width(values, confidence=0.95) -> float:
+    """
+    The half-width of the confidence interval of the mean, relative to it.
+
+    Parameters
+    ----------
+    values : array-like of float
+        The replicate measurements.
+    confidence : float
+        The confidence level of the interval.
+
+    Returns
+    -------
+    float
+        The half-width divided by the mean. This is infinite with fewer
+        than two measurements.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2:
+        return np.inf
+
+    sem = values.std(ddof=1) / np.sqrt(len(values))
+    half = stats.t.ppf((1 + confidence) / 2, len(values) - 1) * sem
+    return half / abs(values.mean())
+
+
+def outliers(values, threshold=3.5) -> np.ndarray:
+    """
+    Flag outlying measurements using the modified z-score.
+
+    The modified z-score uses the median and the median absolute deviation,
+    so a single slow run cannot hide itself by inflating the spread.
+
+    Parameters
+    ----------
+    values : array-like of float
+        The replicate measurements.
+    threshold : float
+        The modified z-score above which a measurement is an outlier.
+
+    Returns
+    -------
+    numpy.ndarray of bool
+        Whether each measurement is an outlier.
+    """
+    values = np.asarray(values, dtype=float)
+    mad = np.median(np.abs(values - np.median(values)))
+    if not mad:
+        return np.zeros(len(values), dtype=bool)
+
+    return 0.6745 * np.abs(values - np.median(values)) / mad > threshold
+
+
+def converged(times, mems, width=0.05, min_reps=3, confidence=0.95) -> bool:
+    """
+    Are the wall time and memory of a configuration measured precisely enough?
+
+    Outliers are excluded before the confidence intervals are calculated.
+
+    Parameters
+    ----------
+    times : array-like of float
+        The wall time of each replicate.
+    mems : array-like of float
+        The peak RSS of each replicate.
+    width : float
+        The largest acceptable half-width of the confidence intervals,
+        relative to the mean.
+    min_reps : int
+        The minimum number of replicates.
+    confidence : float
+        The confidence level of the intervals.
+
+    Returns
+    -------
+    bool
+        True if both intervals are narrow enough.
+    """
+    if len(times) < min_reps:
+        return False
+
+    keep = ~(outliers(times) | outliers(mems))
+    times = np.asarray(times, dtype=float)[keep]
+    mems = np.asarray(mems, dtype=float)[keep]
+    return max(ci_width(times, confidence), ci_width(mems, confidence)) <= width
+
+
+def tool_version(lines, tool) -> str:
+    """
+    Find the version of a tool from the lines of its log.
+
+    Parameters
+    ----------
+    lines : list of str
+        The output of the tool.
+    tool : str
+        The name of the tool.
+
+    Returns
+    -------
+    str or None
+        The version, if it was logged.
+    """
+    pattern = re.compile(rf"{tool} version (\S+)", re.IGNORECASE)
+    for line in lines:
+        match = pattern.search(line)
+        if match:
+            return match.group(1).rstrip(",")
+
+    return None
+
+
+class History:
+    """
+    An append-only database of benchmark runs.
+
+    Parameters
+    ----------
+    db_file : str
+        The SQLite database. It is created if it does not exist.
+    host : str, optional
+        The host to record runs for. By default, this is the name of this
+        machine.
+    """
+
+    def __init__(self, db_file, host=None):
+        """Initialize a History"""
+        self.db_file = db_file
+        self.host = host if host is not None else platform.node()
+        with sqlite3.connect(self.db_file) as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'runs'"
+            if conn.execute(query).fetchone() is None:
+                conn.execute(SCHEMA)
+            else:
+                columns = [r[1] for r in conn.execute("PRAGMA table_info(runs)")]
+                for migration in range(version + 1, SCHEMA_VERSION + 1):
+                    column, definition = MIGRATIONS[migration]
+                    if column not in columns:
+                        logging.info("Adding %s to %s.", column, db_file)
+                        conn.execute(
+                            f"ALTER TABLE runs ADD COLUMN {column} {definition}"
+                        )
+
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def append(self, runs):
+        """
+        Add runs to the history.
+
+        Runs that are already recorded, based on their host, tool, and
+        start time, are ignored.
+
+        Parameters
+        ----------
+        runs : pandas.DataFrame
+            The runs, with the columns in ``COLUMNS`` other than ``host``.
+        """
+        runs = runs.assign(host=self.host).loc[:, COLUMNS]
+        runs = runs.astype(object).where(runs.notna(), None)
+        query = "INSERT OR IGNORE INTO runs ({}) VALUES ({})".format(
+            ", ".join(COLUMNS), ", ".join("?" for _ in COLUMNS)
+        )
+        with sqlite3.connect(self.db_file) as conn:
+            conn.executemany(query, runs.itertuples(index=False, name=None))
+
+    def load(self, tool=None) -> pd.DataFrame:
+        """
+        Load the runs recorded for this host.
+
+        Parameters
+        ----------
+        tool : str, optional
+            Only load runs of this tool.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The runs.
+        """
+        query = "SELECT * FROM runs WHERE host = ?"
+        params = [self.host]
+        if tool is not None:
+            query += " AND tool = ?"
+            params.append(tool)
+
+        with sqlite3.connect(self.db_file) as conn:
+            return pd.read_sql_query(query, conn, params=params)
+
+
+def regression_report(current, history, threshold=0.05, alpha=0.05):
+    """
+    Compare the current runs against earlier runs of each configuration.
+
+    A configuration is flagged when its mean wall time or peak RSS is more
+    than ``threshold`` higher than before and the difference is significant
+    by Welch's t-test. Outliers are excluded from both sets of runs.
+
+    Parameters
+    ----------
+    current : pandas.DataFrame
+        The current runs.
+    history : pandas.DataFrame
+        The earlier runs, as from ``History.load()``. Any of the current
+        runs that it contains are ignored.
+    threshold : float
+        The smallest relative increase to report as a regression.
+    alpha : float
+        The significance level of the t-test.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per configuration and metric, with the previous and
+        current versions and means, the relative change, the p-value, and
+        whether it is a regression.
+    """
+    keys = ["dataset", "tool", "psms", "threads"]
+    history = history.loc[~history["start"].isin(current["start"]), :]
+    history = history.loc[~history["outlier"].astype(bool), :]
+    current = current.loc[~current["outlier"].astype(bool), :]
+
+    rows = []
+    for config, curr in current.groupby(keys, dropna=False):
+        prev = history
+        for key, val in zip(keys, config):
+            prev = prev.loc[prev[key].isna() if pd.isna(val) else prev[key] == val]
+
+        if prev.empty:
+            continue
+
+        for metric in ("wall_time", "max_rss"):
+            before = prev[metric].mean()
+            after = curr[metric].mean()
+            change = after / before - 1
+            if len(prev) > 1 and len(curr) > 1:
+                pval = stats.ttest_ind(curr[metric], prev[metric], equal_var=False)[1]
+            else:
+                pval = np.nan
+
+            rows.append(
+                {
+                    **dict(zip(keys, config)),
+                    "metric": metric,
+                    "previous_version": ", ".join(prev["version"].dropna().unique()),
+                    "current_version": ", ".join(curr["version"].dropna().unique()),
+                    "previous": before,
+                    "current": after,
+                    "change": change,
+                    "p_value": pval,
+                    "regression": change > threshold and pval < alpha,
+                }
+            )
+
+    report = pd.DataFrame(rows)
+    if report.empty:
+        return report
+
+    for _, row in report.loc[report["regression"].astype(bool), :].iterrows():
+        logging.warning(
+            "Regression: %s with %i PSMs is %.1f%% worse in %s (p=%.3g).",
+            row["tool"],
+            row["psms"],
+            100 * row["change"],
+            row["metric"],
+            row["p_value"],
+        )
+
+    return report
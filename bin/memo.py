@@ -0,0 +1,432 @@
+"""
+Memoize the steps of an analysis on the contents of their inputs.
+
+A step is keyed by its name and arguments, the checksums of its input
+files, any other parameters, and the version of the tool that runs it. Its outputs are
+saved in a content-addressed cache, so when a step is run again with the
+same key, its outputs are restored rather than recomputed, and when any
+part of the key changes, the step is run again even if its outputs
+already exist.
+
+Outputs are copied into the cache as read-only files, and restored
+outputs are hard linked to them when possible, so they take no extra
+space. The least recently used files are evicted when the cache grows
+beyond its size limit.
+"""
+import os
+import json
+import stat
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import functools
+
+CACHE_DIR = os.getenv(
+    "MEMO_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "cache"),
+)
+MAX_SIZE = float(os.getenv("MEMO_CACHE_SIZE", 200e9))  # bytes
+DB_TIMEOUT = 60  # seconds to wait for other writers to the database
+
+# Keyword arguments of steps that affect how they run, not what they create.
+RUN_ARGUMENTS = ("log_file", "cpus")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS used (
+    sha256 TEXT PRIMARY KEY,
+    last_used REAL NOT NULL
+);
+"""
+
+
+def memoize(
+    step, outputs, inputs=(), params=None, tool=None, force=False, cache_dir=None
+):
+    """
+    Run a step, unless its outputs are cached for the same inputs.
+
+    Parameters
+    ----------
+    step : callable
+        The step, which is called with no arguments and must create the
+        outputs. Use ``functools.partial`` to give it arguments, which are
+        part of the key, except for the keywords in ``RUN_ARGUMENTS``.
+    outputs : list of str
+        The files or directories that the step creates.
+    inputs : list of str
+        The files or directories that the step reads. Their contents are
+        part of the key.
+    params : dict, optional
+        Other parameters that affect the outputs, such as constants that
+        the step uses. They must be serializable to JSON.
+    tool : str, optional
+        The version of the tool that runs the step.
+    force : bool
+        Run the step even if its outputs are cached?
+    cache_dir : str, optional
+        The cache. By default, this is ``CACHE_DIR``, which can be set with
+        the ``MEMO_CACHE`` environment variable.
+
+    Returns
+    -------
+    object
+        What the step returned, or None if its outputs were restored.
+    """
+    cache = Cache(cache_dir)
+    name = _name(step)
+    for in_file in inputs:
+        if not os.path.exists(in_file):
+            raise FileNotFoundError(f"The input {in_file} of {name} does not exist.")
+
+    key = cache.key(name, outputs, inputs, params, tool, _arguments(step))
+    if not force and cache.restore(key, outputs):
+        logging.info("Using cached outputs of %s (%s).", name, key[:12])
+        return None
+
+    for out in outputs:
+        _remove(out)  # Never write through links into the cache.
+
+    result = step()
+    for out in outputs:
+        if not os.path.exists(out):
+            raise FileNotFoundError(f"{name} did not create {out}.")
+
+    cache.store(key, outputs)
+    return result
+
+
+class Cache:
+    """
+    A content-addressed cache of files.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        The cache directory. By default, this is ``CACHE_DIR``.
+    max_size : float, optional
+        The size of the cache in bytes, beyond which the least recently
+        used files are evicted. By default, this is ``MAX_SIZE``, which can
+        be set with the ``MEMO_CACHE_SIZE`` environment variable.
+    """
+
+    def __init__(self, cache_dir=None, max_size=None):
+        """Initialize a Cache"""
+        self.cache_dir = cache_dir if cache_dir is not None else CACHE_DIR
+        self.max_size = max_size if max_size is not None else MAX_SIZE
+        self._objects = os.path.join(self.cache_dir, "objects")
+        self._keys = os.path.join(self.cache_dir, "keys")
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._keys, exist_ok=True)
+        # Write-ahead logging lets readers continue while another writes.
+        with sqlite3.connect(self._hash_db, timeout=DB_TIMEOUT) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @property
+    def _hash_db(self):
+        """The database of checksums for unchanged files"""
+        return os.path.join(self.cache_dir, "hashes.sqlite")
+
+    def key(
+        self, name, outputs, inputs=(), params=None, tool=None, arguments=None
+    ) -> str:
+        """
+        Calculate the key of a step.
+
+        Parameters
+        ----------
+        name : str
+            The name of the step.
+        outputs : list of str
+            The outputs of the step.
+        inputs : list of str
+            The input files or directories of the step.
+        params : dict, optional
+            The parameters of the step.
+        tool : str, optional
+            The version of the tool.
+        arguments : dict, optional
+            The arguments of the step.
+
+        Returns
+        -------
+        str
+            The key, as a hexadecimal digest.
+        """
+        record = {
+            "step": name,
+            "arguments": arguments,
+            "outputs": [os.path.normpath(o) for o in outputs],
+            "inputs": [self.checksum(i) for i in inputs],
+            "params": params,
+            "tool": tool,
+        }
+        record = json.dumps(record, sort_keys=True, default=_serialize)
+        return hashlib.sha256(record.encode()).hexdigest()
+
+    def checksum(self, path) -> str:
+        """
+        The SHA-256 checksum of a file or directory.
+
+        Checksums of files are saved with their size and modification time,
+        so unchanged files are not read again. The checksum of a directory
+        covers the relative paths and contents of all of its files.
+
+        Parameters
+        ----------
+        path : str
+            The file or directory.
+
+        Returns
+        -------
+        str
+            The hexadecimal digest.
+        """
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for rel_path in _files(path):
+                digest.update(rel_path.encode())
+                digest.update(self.checksum(os.path.join(path, rel_path)).encode())
+
+            return digest.hexdigest()
+
+        path = os.path.abspath(path)
+        info = os.stat(path)
+        query = "SELECT sha256 FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ?"
+        with sqlite3.connect(self._hash_db, timeout=DB_TIMEOUT) as conn:
+            row = conn.execute(query, (path, info.st_size, info.st_mtime_ns)).fetchone()
+
+        if row is not None:
+            return row[0]
+
+        digest = checksum(path)
+        with sqlite3.connect(self._hash_db, timeout=DB_TIMEOUT) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                (path, info.st_size, info.st_mtime_ns, digest),
+            )
+
+        return digest
+
+    def restore(self, key, outputs) -> bool:
+        """
+        Put the cached outputs of a step in place.
+
+        Parameters
+        ----------
+        key : str
+            The key of the step.
+        outputs : list of str
+            The outputs of the step.
+
+        Returns
+        -------
+        bool
+            False if the outputs are not cached.
+        """
+        try:
+            with open(os.path.join(self._keys, key + ".json")) as record:
+                files = json.load(record)["files"]
+        except FileNotFoundError:
+            return False
+
+        objects = {f: self._object(h) for f, h in files.items()}
+        if not all(os.path.isfile(o) for o in objects.values()):
+            return False
+
+        current = all(
+            os.path.isfile(f) and self.checksum(f) == files[f] for f in objects
+        )
+        if not current:
+            for out in outputs:
+                _remove(out)
+
+            for out_file, obj in objects.items():
+                os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+                _link(obj, out_file)
+
+        self._mark_used(files.values())
+        return True
+
+    def store(self, key, outputs):
+        """
+        Save the outputs of a step in the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key of the step.
+        outputs : list of str
+            The files or directories that the step created.
+        """
+        files = {}
+        for out in outputs:
+            if os.path.isdir(out):
+                paths = [os.path.join(out, f) for f in _files(out)]
+            else:
+                paths = [out]
+
+            for path in paths:
+                digest = self.checksum(path)
+                obj = self._object(digest)
+                if not os.path.isfile(obj):
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    # A copy, so that the output itself stays writable.
+                    tmp_file = _temp_file(obj)
+                    shutil.copy2(path, tmp_file)
+                    os.chmod(tmp_file, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    os.replace(tmp_file, obj)
+
+                files[os.path.normpath(path)] = digest
+
+        self._mark_used(files.values())
+        record_file = os.path.join(self._keys, key + ".json")
+        tmp_file = _temp_file(record_file)
+        with open(tmp_file, "w") as record:
+            json.dump({"time": time.time(), "files": files}, record, indent=1)
+
+        os.replace(tmp_file, record_file)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits"""
+        with sqlite3.connect(self._hash_db, timeout=DB_TIMEOUT) as conn:
+            last_used = dict(conn.execute("SELECT sha256, last_used FROM used"))
+
+        objects = []
+        for root, _, names in os.walk(self._objects):
+            for name in names:
+                if name.startswith("."):
+                    continue  # A file that is still being copied in.
+
+                path = os.path.join(root, name)
+                digest = os.path.basename(root) + name
+                info = os.stat(path)
+                used = last_used.get(digest, info.st_mtime)
+                objects.append((used, info.st_size, path, digest))
+
+        size = sum(o[1] for o in objects)
+        evicted = []
+        for _, obj_size, path, digest in sorted(objects):
+            if size <= self.max_size:
+                break
+
+            logging.debug("Evicting %s from the cache.", path)
+            os.remove(path)
+            evicted.append((digest,))
+            size -= obj_size
+
+        with sqlite3.connect(self._hash_db, timeout=DB_TIMEOUT) as conn:
+            conn.executemany("DELETE FROM used WHERE sha256 = ?", evicted)
+
+    def _mark_used(self, digests):
+        """Record that cached files were used now"""
+        # The objects are hard linked to outputs, so their own modification
+        # times must not change: that would invalidate the saved checksums.
+        now = time.time()
+        with sqlite3.connect(self._hash_db, timeout=DB_TIMEOUT) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO used VALUES (?, ?)",
+                [(d, now) for d in set(digests)],
+            )
+
+    def _object(self, digest):
+        """The path of a cached file"""
+        return os.path.join(self._objects, digest[:2], digest[2:])
+
+
+def checksum(path) -> str:
+    """
+    The SHA-256 checksum of a file, without saving it in a cache.
+
+    Parameters
+    ----------
+    path : str
+        The file.
+
+    Returns
+    -------
+    str
+        The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as data:
+        for chunk in iter(lambda: data.read(2 ** 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _name(step):
+    """The name of a step"""
+    while isinstance(step, functools.partial):
+        step = step.func
+
+    return f"{step.__module__}.{step.__qualname__}"
+
+
+def _arguments(step, ignore=RUN_ARGUMENTS):
+    """The arguments that a step is called with, from its partials"""
+    args = []
+    kwargs = {}
+    while isinstance(step, functools.partial):
+        args = list(step.args) + args
+        kwargs = {**step.keywords, **kwargs}
+        step = step.func
+
+    kwargs = {k: v for k, v in kwargs.items() if k not in ignore}
+    return {"args": args, "kwargs": kwargs}
+
+
+def _serialize(obj):
+    """A stable JSON representation of an argument"""
+    if callable(obj):
+        return _name(obj)  # Rather than a repr with its memory address.
+
+    return str(obj)
+
+
+def _files(directory):
+    """The relative paths of the files in a directory, sorted"""
+    paths = []
+    for root, _, names in os.walk(directory):
+        paths += [os.path.relpath(os.path.join(root, n), directory) for n in names]
+
+    return sorted(paths)
+
+
+def _link(src, dest):
+    """Hard link a file, or copy it to another file system"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def _temp_file(path):
+    """A new, hidden temporary file to be renamed to a path"""
+    # Unique even between the threads of a process, unlike the process ID.
+    fd, tmp_file = tempfile.mkstemp(
+        suffix=".tmp",
+        prefix=f".{os.path.basename(path)}.",
+        dir=os.path.dirname(path),
+    )
+    os.close(fd)
+    return tmp_file
+
+
+def _remove(path):
+    """Remove a file or directory, if it exists"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
@@ -0,0 +1,464 @@
+"""
+Measure the resources used by external commands.
+
+Commands are launched without a shell and their whole process tree is
+sampled at a fixed interval, recording the memory, CPU time, and the
+cores in use. Each line of output is also timestamped, so that the
+samples can be lined up with what the tool was doing at the time.
+
+Work done within Python can instead be split into stages with a
+StageTimer, which records the same measurements for each stage.
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import functools
+import threading
+import subprocess
+from contextlib import contextmanager
+
+import psutil
+
+INTERVAL = 0.5
+
+# Lines of output that report progress, such as percentages and counts.
+PROGRESS = re.compile(
+    r"\d+(\.\d+)?\s*%|\b\d+\s*(/|of)\s*\d+\b|complete|elapsed time", re.IGNORECASE
+)
+
+
+def run(
+    cmd,
+    log_file,
+    profile_file=None,
+    interval=INTERVAL,
+    cpus=None,
+    check=True,
+    **kwargs,
+) -> dict:
+    """
+    Run a command while monitoring the resources of its process tree.
+
+    Parameters
+    ----------
+    cmd : list of str
+        The command to run.
+    log_file : str or file-like
+        The file to which stdout and stderr of the command are written, or
+        an open file to write them to. If None, they are written to stdout.
+    profile_file : str, optional
+        The JSON file in which to save the profile.
+    interval : float
+        The number of seconds between samples.
+    cpus : list of int, optional
+        The cores to which the command is restricted.
+    check : bool
+        Raise an error if the command fails?
+    **kwargs : dict
+        Keyword arguments passed to ``subprocess.Popen``.
+
+    Returns
+    -------
+    dict
+        The profile. ``wall_time`` and ``cpu_time`` are in seconds.
+        ``max_rss`` is the peak RSS of the whole process tree in MB, and
+        ``max_process_rss`` is the peak of its largest single process.
+        ``samples`` is the time series of the process tree and ``lines``
+        holds the timestamped output.
+    """
+    cmd = [str(c) for c in cmd]
+    logging.debug("Running: %s", " ".join(cmd))
+    lines = []
+    samples = []
+    exit_info = []
+    # preexec_fn is not safe with threads running, so taskset pins the cores.
+    popen_cmd = cmd
+    if cpus is not None:
+        popen_cmd = ["taskset", "-c", ",".join(str(c) for c in cpus)] + cmd
+
+    start = time.time()
+    core_times = [psutil.cpu_times(percpu=True)]
+    if log_file is None:
+        log_file = sys.stdout
+
+    with _open_log(log_file) as log:
+        proc = subprocess.Popen(
+            popen_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            errors="replace",
+            **kwargs,
+        )
+
+        reader = threading.Thread(target=_read, args=(proc.stdout, log, lines, start))
+        waiter = threading.Thread(target=_wait, args=(proc, exit_info))
+        reader.start()
+        waiter.start()
+        try:
+            tree = psutil.Process(proc.pid)
+            while waiter.is_alive():
+                samples.append(_sample(tree, start, core_times))
+                waiter.join(interval)
+        except psutil.NoSuchProcess:
+            pass  # It finished before the first sample.
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            waiter.join()
+            reader.join()
+            proc.stdout.close()
+
+    end, status, usage = exit_info
+    proc.returncode = _exit_code(status)
+
+    # The kernel only reports the peak of the largest process, so the tree
+    # total comes from the samples. A process may peak between samples.
+    max_process_rss = usage.ru_maxrss / 1000
+    max_tree_rss = max((s["rss"] for s in samples), default=0)
+    profile = {
+        "cmd": cmd,
+        "start": start,
+        "returncode": proc.returncode,
+        "cpus": sorted(cpus) if cpus is not None else None,
+        "wall_time": end - start,
+        "cpu_time": usage.ru_utime + usage.ru_stime,
+        "max_rss": max(max_tree_rss, max_process_rss),
+        "max_process_rss": max_process_rss,
+        "interval": interval,
+        "samples": samples,
+        "lines": lines,
+    }
+
+    if profile_file is not None:
+        with open(profile_file, "w") as out:
+            json.dump(profile, out)
+
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    return profile
+
+
+def load_profile(profile_file) -> dict:
+    """
+    Load a profile saved by ``run()``.
+
+    Parameters
+    ----------
+    profile_file : str
+        The JSON profile.
+
+    Returns
+    -------
+    dict
+        The profile.
+    """
+    with open(profile_file) as prof:
+        return json.load(prof)
+
+
+def step_record(profile, step, pattern=PROGRESS) -> dict:
+    """
+    Summarize a profile as a record of one step of a pipeline.
+
+    Parameters
+    ----------
+    profile : dict
+        A profile from ``run()``.
+    step : str
+        The name of the step.
+    pattern : re.Pattern
+        Lines of output matching this are kept as progress reports.
+
+    Returns
+    -------
+    dict
+        The step, command, start time, return code, wall time, CPU time,
+        and peak RSS of the step, the number of samples and peak number
+        of processes, and the progress lines with the seconds at which
+        they were written.
+    """
+    samples = profile["samples"]
+    return {
+        "step": step,
+        "cmd": profile["cmd"],
+        "start": profile["start"],
+        "returncode": profile["returncode"],
+        "wall_time": profile["wall_time"],
+        "cpu_time": profile["cpu_time"],
+        "max_rss": profile["max_rss"],
+        "num_samples": len(samples),
+        "max_procs": max((s["num_procs"] for s in samples), default=1),
+        "progress": [(t, l) for t, l in profile["lines"] if pattern.search(l)],
+    }
+
+
+def log_stages(profile, markers) -> list:
+    """
+    Split a profile into stages using the timestamps of its output.
+
+    Each stage begins at the first line matching its pattern and ends when
+    the next stage begins. The first stage always begins when the command
+    was launched and the last ends when it exited. Stages whose pattern is
+    never matched are omitted.
+
+    Parameters
+    ----------
+    profile : dict
+        A profile from ``run()``.
+    markers : list of tuple of (str, str)
+        The name of each stage and a regular expression matching the line
+        of output where it begins, in the order they occur.
+
+    Returns
+    -------
+    list of dict
+        The wall time, CPU time, and peak RSS of each stage, in the same
+        format as ``StageTimer.records``.
+    """
+    starts = []
+    for idx, (name, pattern) in enumerate(markers):
+        if not idx:
+            starts.append((name, 0.0))
+            continue
+
+        pattern = re.compile(pattern)
+        for elapsed, line in profile["lines"]:
+            if pattern.search(line):
+                starts.append((name, elapsed))
+                break
+
+    samples = profile["samples"]
+    ends = [s for _, s in starts[1:]] + [profile["wall_time"]]
+    records = []
+    for (name, start), end in zip(starts, ends):
+        within = [s for s in samples if start <= s["time"] <= end]
+        cpu = [s["cpu_time"] for s in within]
+        records.append(
+            {
+                "stage": name,
+                "start": start,
+                "end": end,
+                "wall_time": end - start,
+                "cpu_time": max(cpu) - min(cpu) if cpu else float("nan"),
+                "max_rss": max(s["rss"] for s in within) if within else float("nan"),
+                "depth": 0,
+            }
+        )
+
+    return records
+
+
+class StageTimer:
+    """
+    Record the resources used by stages of work in the current process.
+
+    Stages may be nested. Memory is sampled on a background thread, so the
+    peak RSS of each stage is accurate to within the sampling interval.
+
+    Parameters
+    ----------
+    interval : float
+        The number of seconds between memory samples.
+
+    Attributes
+    ----------
+    records : list of dict
+        The stage name, start and end times in seconds, wall time and CPU
+        time in seconds, peak RSS in MB, and nesting depth of each stage
+        in the order they finished.
+    """
+
+    def __init__(self, interval=0.05):
+        """Initialize a StageTimer"""
+        self.interval = interval
+        self.records = []
+        self._proc = psutil.Process()
+        self._start = time.time()
+        self._peaks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of work.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        """
+        with self._lock:
+            self._peaks.append(self._proc.memory_info().rss)
+            depth = len(self._peaks) - 1
+
+        start = time.time()
+        cpu = self._cpu_time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            cpu = self._cpu_time() - cpu
+            rss = self._proc.memory_info().rss
+            with self._lock:
+                peak = max(self._peaks.pop(), rss)
+
+            self.records.append(
+                {
+                    "stage": name,
+                    "start": start - self._start,
+                    "end": end - self._start,
+                    "wall_time": end - start,
+                    "cpu_time": cpu,
+                    "max_rss": peak / 1e6,
+                    "depth": depth,
+                }
+            )
+
+    def wrap(self, func, name):
+        """
+        Time every call to a function as a separate stage.
+
+        Parameters
+        ----------
+        func : callable
+            The function to time.
+        name : str
+            The name of the stages. Calls are numbered from one, so the
+            stages are named ``{name}_1``, ``{name}_2``, and so on.
+
+        Returns
+        -------
+        callable
+            The wrapped function.
+        """
+        calls = [0]
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            calls[0] += 1
+            with self.stage(f"{name}_{calls[0]}"):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def save(self, out_file):
+        """
+        Save the stage records to a JSON file.
+
+        Parameters
+        ----------
+        out_file : str
+            The JSON file to create.
+        """
+        with open(out_file, "w") as out:
+            json.dump({"start": self._start, "stages": self.records}, out)
+
+    def close(self):
+        """Stop sampling memory"""
+        self._done.set()
+        self._sampler.join()
+
+    def _cpu_time(self):
+        """The CPU time used by this process so far"""
+        times = self._proc.cpu_times()
+        return times.user + times.system
+
+    def _sample(self):
+        """Update the peak RSS of every open stage"""
+        while not self._done.wait(self.interval):
+            rss = self._proc.memory_info().rss
+            with self._lock:
+                self._peaks = [max(p, rss) for p in self._peaks]
+
+
+def _sample(tree, start, core_times):
+    """Take one sample of the resources used by a process tree"""
+    try:
+        procs = [tree] + tree.children(recursive=True)
+    except psutil.NoSuchProcess:
+        procs = []
+
+    rss = 0
+    cpu_time = 0
+    cores = set()
+    for proc in procs:
+        try:
+            with proc.oneshot():
+                rss += proc.memory_info().rss
+                times = proc.cpu_times()
+                cpu_time += times.user + times.system
+                cpu_time += times.children_user + times.children_system
+                cores.add(proc.cpu_num())
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+
+    return {
+        "time": time.time() - start,
+        "rss": rss / 1e6,
+        "cpu_time": cpu_time,
+        "num_procs": len(procs),
+        "cores": sorted(cores),
+        "cpu_percent": _core_percent(core_times),
+    }
+
+
+def _core_percent(core_times):
+    """The utilization of each core since the previous sample"""
+    now = psutil.cpu_times(percpu=True)
+    percent = []
+    for prev, curr in zip(core_times[0], now):
+        total = sum(curr) - sum(prev)
+        idle = curr.idle - prev.idle
+        percent.append(100 * (1 - idle / total) if total > 0 else 0.0)
+
+    core_times[0] = now
+    return percent
+
+
+@contextmanager
+def _open_log(log_file):
+    """Open a log file, or use one that is already open"""
+    if hasattr(log_file, "write"):
+        yield log_file
+        return
+
+    with open(log_file, "w") as log:
+        yield log
+
+
+def _read(stream, log, lines, start):
+    """Copy output to the log, recording when each line arrived"""
+    for line in stream:
+        log.write(line)
+        lines.append((time.time() - start, line.rstrip("\n")))
+
+    log.flush()
+
+
+def _wait(proc, exit_info):
+    """Wait for a process to exit, recording when and its resource usage"""
+    _, status, usage = os.wait4(proc.pid, 0)
+    exit_info.extend([time.time(), status, usage])
+
+
+def _exit_code(status):
+    """Convert a wait status to a return code like subprocess"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
@@ -0,0 +1,273 @@
+"""
+Seekable, block-compressed mzML files.
+
+mzML files are compressed in the BGZF format used by samtools: a series of
+independent gzip members of at most 64 kB each, so the file is still a
+valid gzip file that any tool can decompress. Alongside it, an index
+records where each spectrum begins as a virtual offset, the position of
+its compressed block shifted left 16 bits plus its position within the
+decompressed block. Reading one spectrum then only requires decompressing
+the few blocks it spans.
+"""
+import os
+import re
+import gzip
+import zlib
+import base64
+import struct
+import logging
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+BLOCK_SIZE = 0xFF00  # The most data in a block, as in samtools.
+INDEX_EXT = ".idx.npy"
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+SCAN = re.compile(rb'<spectrum [^>]*\bid="([^"]*)"')
+SCAN_NUMBER = re.compile(rb"\bscan=(\d+)")
+INDEX = re.compile(rb'\bindex="(\d+)"')
+
+# The controlled vocabulary terms that describe binary data arrays.
+ARRAYS = {"MS:1000514": "mz", "MS:1000515": "intensity"}
+FLOATS = {"MS:1000521": np.float32, "MS:1000523": np.float64}
+ZLIB = "MS:1000574"
+MS_LEVEL = "MS:1000511"
+
+
+class BlockWriter:
+    """
+    Write a BGZF file.
+
+    Parameters
+    ----------
+    out_file : str
+        The file to create.
+    level : int
+        The zlib compression level.
+    """
+
+    def __init__(self, out_file, level=6):
+        """Initialize a BlockWriter"""
+        self.level = level
+        self._out = open(out_file, "wb")
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def tell(self) -> int:
+        """The virtual offset of the next byte to be written"""
+        return (self._out.tell() << 16) | len(self._buffer)
+
+    def write(self, data):
+        """
+        Write data, compressing each block as it fills.
+
+        Parameters
+        ----------
+        data : bytes
+            The data to write.
+        """
+        self._buffer += data
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._flush(BLOCK_SIZE)
+
+    def close(self):
+        """Compress any remaining data and write the end-of-file block"""
+        while self._buffer:
+            self._flush(BLOCK_SIZE)
+
+        self._out.write(EOF_BLOCK)
+        self._out.close()
+
+    def _flush(self, size):
+        """Compress the first bytes of the buffer into a block"""
+        data = bytes(self._buffer[:size])
+        comp = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = comp.compress(data) + comp.flush()
+        if len(cdata) + 26 > 0x10000:
+            return self._flush(size // 2)  # Incompressible, so use less.
+
+        header = struct.pack(
+            "<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25
+        )
+        footer = struct.pack("<2I", zlib.crc32(data), len(data))
+        self._out.write(header + cdata + footer)
+        del self._buffer[:size]
+
+
+def index_file(mzml_file) -> str:
+    """
+    The spectrum index of a block-compressed mzML file.
+
+    Parameters
+    ----------
+    mzml_file : str
+        The block-compressed mzML file.
+
+    Returns
+    -------
+    str
+        The index file.
+    """
+    return mzml_file + INDEX_EXT
+
+
+def compress(mzml_file, out_file, level=6) -> str:
+    """
+    Compress an mzML file into a seekable BGZF file and index its spectra.
+
+    The mzML file is read one line at a time, so memory use does not
+    depend on its size. Spectra are indexed by the scan number in their
+    ID or, if there is none, by their index in the file.
+
+    Parameters
+    ----------
+    mzml_file : str
+        The mzML file to compress. It may be gzipped.
+    out_file : str
+        The block-compressed mzML file to create. The index is saved next
+        to it, as given by ``index_file()``.
+    level : int
+        The zlib compression level.
+
+    Returns
+    -------
+    str
+        The block-compressed mzML file.
+    """
+    logging.info("Compressing %s...", mzml_file)
+    opener = gzip.open if mzml_file.endswith(".gz") else open
+    index = []
+    with opener(mzml_file, "rb") as mzml, BlockWriter(out_file, level) as out:
+        start = scan = length = None
+        for line in mzml:
+            if start is None:
+                match = SCAN.search(line)
+                if match is not None:
+                    scan = SCAN_NUMBER.search(match.group(1))
+                    if scan is None:
+                        scan = INDEX.search(line)
+
+                    scan = int(scan.group(1))
+                    pos = line.index(b"<spectrum ")
+                    out.write(line[:pos])
+                    line = line[pos:]
+                    start = out.tell()
+                    length = 0
+
+            if start is not None:
+                end = line.find(b"</spectrum>")
+                if end < 0:
+                    length += len(line)
+                else:
+                    length += end + len(b"</spectrum>")
+                    index.append((scan, start, length))
+                    start = None
+
+            out.write(line)
+
+    index = np.array(index, dtype=np.int64).reshape(-1, 3)
+    tmp_file = index_file(out_file) + ".tmp.npy"
+    np.save(tmp_file, index)
+    os.replace(tmp_file, index_file(out_file))
+    return out_file
+
+
+class SpectrumReader:
+    """
+    Random access to the spectra of a block-compressed mzML file.
+
+    Parameters
+    ----------
+    mzml_file : str
+        A block-compressed mzML file created by ``compress()``.
+
+    Attributes
+    ----------
+    scans : numpy.ndarray
+        The scan number of each spectrum.
+    """
+
+    def __init__(self, mzml_file):
+        """Initialize a SpectrumReader"""
+        self.mzml_file = mzml_file
+        index = np.load(index_file(mzml_file))
+        self.scans = index[:, 0]
+        self._offsets = dict(zip(index[:, 0].tolist(), index[:, 1:].tolist()))
+        self._file = open(mzml_file, "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.scans)
+
+    def __contains__(self, scan):
+        return scan in self._offsets
+
+    def close(self):
+        """Close the mzML file"""
+        self._file.close()
+
+    def xml(self, scan) -> str:
+        """
+        Read the XML of a spectrum.
+
+        Parameters
+        ----------
+        scan : int
+            The scan number.
+
+        Returns
+        -------
+        str
+            The ``<spectrum>`` element.
+        """
+        voffset, length = self._offsets[scan]
+        self._file.seek(voffset >> 16)
+        with gzip.GzipFile(fileobj=self._file, mode="rb") as blocks:
+            blocks.read(voffset & 0xFFFF)
+            return blocks.read(length).decode()
+
+    def spectrum(self, scan) -> dict:
+        """
+        Read a spectrum.
+
+        Parameters
+        ----------
+        scan : int
+            The scan number.
+
+        Returns
+        -------
+        dict
+            The scan number, the ``id`` of the spectrum, its MS level, and
+            its m/z and intensity arrays.
+        """
+        elem = ET.fromstring(self.xml(scan))
+        spec = {"scan": scan, "id": elem.get("id"), "ms_level": None}
+        for param in elem.iter("cvParam"):
+            if param.get("accession") == MS_LEVEL:
+                spec["ms_level"] = int(param.get("value"))
+
+        for array in elem.iter("binaryDataArray"):
+            terms = {p.get("accession") for p in array.iter("cvParam")}
+            name = [ARRAYS[t] for t in terms if t in ARRAYS]
+            if not name:
+                continue
+
+            data = base64.b64decode(array.find("binary").text or "")
+            if ZLIB in terms:
+                data = zlib.decompress(data)
+
+            dtype = [FLOATS[t] for t in terms if t in FLOATS][0]
+            spec[name[0]] = np.frombuffer(data, dtype=dtype).astype(float)
+
+        return spec
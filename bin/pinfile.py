@@ -0,0 +1,464 @@
+"""
+Fast access to PIN files.
+
+A PIN file is indexed once by recording the byte offset at which each row
+begins. The index is saved next to the PIN file, so that later calls can
+count and retrieve rows by seeking instead of reading the whole file.
+
+A PIN file can also be converted once to a columnar cache, with one .npy
+file per numeric column, so that later analyses load it without parsing
+any text.
+"""
+import os
+import csv
+import gzip
+import json
+import mmap
+import shutil
+import logging
+
+import mokapot
+import numpy as np
+import pandas as pd
+
+INDEX_EXT = ".idx.npy"
+CACHE_EXT = ".cache"
+CACHE_VERSION = 2  # Increment when the format of the cache changes.
+CHUNK_SIZE = 2 ** 28
+CHUNK_ROWS = 10 ** 6
+
+# PIN columns that are always text, in lower case:
+TEXT_COLUMNS = ["specid", "filename", "peptide", "proteins"]
+
+
+def index_file(pin_file) -> str:
+    """The sidecar index file for a PIN file."""
+    return pin_file + INDEX_EXT
+
+
+def build_index(pin_file, chunk_size=CHUNK_SIZE) -> np.ndarray:
+    """
+    Build and save the line offset index for a PIN file.
+
+    Parameters
+    ----------
+    pin_file : str
+        The uncompressed PIN file to index.
+    chunk_size : int
+        The number of bytes to scan for newlines at a time.
+
+    Returns
+    -------
+    numpy.ndarray
+        The byte offsets of each row. The header is excluded and a final
+        entry marks the end of the last row, so row ``i`` spans
+        ``offsets[i]:offsets[i + 1]``.
+    """
+    logging.info("Indexing %s...", pin_file)
+    size = os.path.getsize(pin_file)
+    if not size:
+        raise ValueError(f"{pin_file} is empty.")
+
+    newlines = []
+    with open(pin_file, "rb") as pin:
+        with mmap.mmap(pin.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for start in range(0, size, chunk_size):
+                count = min(chunk_size, size - start)
+                chunk = np.frombuffer(buf, dtype=np.uint8, count=count, offset=start)
+                newlines.append(np.flatnonzero(chunk == ord("\n")) + start)
+                del chunk
+
+    offsets = np.concatenate(newlines) + 1
+    if not len(offsets) or offsets[-1] != size:
+        offsets = np.append(offsets, size)
+
+    np.save(index_file(pin_file), offsets)
+    return offsets
+
+
+def load_index(pin_file, rebuild=False) -> np.ndarray:
+    """
+    Load the line offset index for a PIN file, building it if needed.
+
+    The index is rebuilt if it is older than the PIN file or does not
+    match its size.
+
+    Parameters
+    ----------
+    pin_file : str
+        The uncompressed PIN file.
+    rebuild : bool
+        Rebuild the index even if it appears to be current?
+
+    Returns
+    -------
+    numpy.ndarray
+        The byte offsets of each row, as returned by ``build_index()``.
+    """
+    idx_file = index_file(pin_file)
+    if not rebuild and os.path.isfile(idx_file):
+        offsets = np.load(idx_file, mmap_mode="r")
+        current = os.path.getmtime(idx_file) >= os.path.getmtime(pin_file)
+        if current and offsets[-1] == os.path.getsize(pin_file):
+            return offsets
+
+    return build_index(pin_file)
+
+
+def num_psms(pin_file) -> int:
+    """The number of PSMs (rows after the header) in a PIN file."""
+    return len(load_index(pin_file)) - 1
+
+
+def read_rows(pin_file, rows, offsets=None) -> list:
+    """
+    Read specific rows from a PIN file.
+
+    Parameters
+    ----------
+    pin_file : str
+        The uncompressed PIN file.
+    rows : array-like of int
+        The zero-based indices of the PSMs to read.
+    offsets : numpy.ndarray, optional
+        The index of the PIN file. It is loaded if not provided.
+
+    Returns
+    -------
+    list of str
+        The requested rows, in the order they were given.
+    """
+    if offsets is None:
+        offsets = load_index(pin_file)
+
+    with open(pin_file, "rb") as pin:
+        with mmap.mmap(pin.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return [buf[offsets[r] : offsets[r + 1]].decode() for r in np.asarray(rows)]
+
+
+def write_rows(pin_file, rows, out_file, offsets=None) -> str:
+    """
+    Write the header and specific rows from a PIN file to a new file.
+
+    Rows are written in file order and consecutive rows are copied
+    together, so taking every row is a plain copy.
+
+    Parameters
+    ----------
+    pin_file : str
+        The uncompressed PIN file.
+    rows : array-like of int
+        The zero-based indices of the PSMs to write.
+    out_file : str
+        The PIN file to create.
+    offsets : numpy.ndarray, optional
+        The index of the PIN file. It is loaded if not provided.
+
+    Returns
+    -------
+    str
+        The new PIN file.
+    """
+    if offsets is None:
+        offsets = load_index(pin_file)
+
+    # Collapse runs of consecutive rows into single byte ranges:
+    rows = np.unique(np.asarray(rows, dtype=int))
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = offsets[rows[np.insert(breaks, 0, 0)]] if len(rows) else []
+    ends = offsets[rows[np.append(breaks, len(rows)) - 1] + 1] if len(rows) else []
+
+    with open(pin_file, "rb") as pin, open(out_file, "wb") as out:
+        with mmap.mmap(pin.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            out.write(buf[: offsets[0]])
+            for start, end in zip(starts, ends):
+                out.write(buf[start:end])
+
+    return out_file
+
+
+def cache_dir(pin_file) -> str:
+    """The columnar cache directory for a PIN file."""
+    return pin_file + CACHE_EXT
+
+
+def build_cache(pin_file, chunk_rows=CHUNK_ROWS) -> str:
+    """
+    Convert a PIN file to a columnar cache.
+
+    Numeric columns are saved as .npy files, in the dtype in which they
+    are read, and text columns as newline-delimited text files. Rows are
+    parsed in chunks, so the whole PIN file is never held in memory. A
+    column that is numeric in the first chunk but not in a later one is
+    converted to text. As in mokapot, any extra fields after the Proteins
+    column are kept in it, separated by tabs.
+
+    Parameters
+    ----------
+    pin_file : str
+        The PIN file to convert, which may be gzipped.
+    chunk_rows : int
+        The number of rows to parse at a time.
+
+    Returns
+    -------
+    str
+        The cache directory.
+    """
+    logging.info("Caching %s...", pin_file)
+    out_dir = cache_dir(pin_file)
+    os.makedirs(out_dir, exist_ok=True)
+    kinds = {}
+    files = {}
+    integral = {}
+    num_psms = 0
+    try:
+        for chunk in _parse_chunks(pin_file, chunk_rows):
+            if not files:
+                kinds = _column_kinds(chunk)
+                files = {c: _open_column(out_dir, c, k) for c, k in kinds.items()}
+                integral = {c: k != "str" for c, k in kinds.items()}
+
+            for col, kind in kinds.items():
+                values = chunk[col]
+                if kind != "str":
+                    values = _to_numeric(values)
+                    if not pd.api.types.is_numeric_dtype(values):
+                        logging.warning(
+                            "%s of %s is not numeric after row %i. Caching it as text.",
+                            col,
+                            pin_file,
+                            num_psms,
+                        )
+                        files[col] = _text_column(
+                            out_dir, col, files[col], integral[col]
+                        )
+                        kinds[col] = kind = "str"
+
+                if kind == "str":
+                    values = values.fillna("")
+                    files[col].write("\n".join(values) + "\n")
+                else:
+                    values = values.to_numpy(dtype=float)
+                    integral[col] &= bool(np.all(np.mod(values, 1) == 0))
+                    files[col].write(values.tobytes())
+
+            num_psms += len(chunk)
+    finally:
+        for out in files.values():
+            out.close()
+
+    for col, kind in kinds.items():
+        if kind != "str":
+            kinds[col] = "int" if integral[col] else "float"
+            _finish_column(out_dir, col, num_psms, kinds[col])
+
+    meta = {
+        "version": CACHE_VERSION,
+        "source": _source_info(pin_file),
+        "num_psms": num_psms,
+        "columns": [{"name": c, "kind": k} for c, k in kinds.items()],
+    }
+
+    with open(os.path.join(out_dir, "meta.json"), "w") as out:
+        json.dump(meta, out)
+
+    return out_dir
+
+
+def read_cache(pin_file, columns=None, rebuild=False) -> pd.DataFrame:
+    """
+    Read a PIN file from its columnar cache, building the cache if needed.
+
+    The cache is rebuilt if the PIN file has changed since it was made.
+
+    Parameters
+    ----------
+    pin_file : str
+        The PIN file, which may be gzipped.
+    columns : list of str, optional
+        Only read these columns.
+    rebuild : bool
+        Rebuild the cache even if it appears to be current?
+
+    Returns
+    -------
+    pandas.DataFrame
+        The PSMs, with the columns of the PIN file.
+    """
+    meta_file = os.path.join(cache_dir(pin_file), "meta.json")
+    meta = None
+    if not rebuild and os.path.isfile(meta_file):
+        with open(meta_file) as meta_in:
+            meta = json.load(meta_in)
+
+    stale = meta is None or meta.get("version") != CACHE_VERSION
+    if stale or meta["source"] != _source_info(pin_file):
+        build_cache(pin_file)
+        with open(meta_file) as meta_in:
+            meta = json.load(meta_in)
+
+    data = {}
+    for col in meta["columns"]:
+        if columns is not None and col["name"] not in columns:
+            continue
+
+        path = os.path.join(cache_dir(pin_file), _column_file(col["name"], col["kind"]))
+        if col["kind"] == "str":
+            with open(path) as text:
+                values = text.read().split("\n")[:-1]
+
+            data[col["name"]] = pd.Series(values, dtype=object).replace("", np.nan)
+        else:
+            data[col["name"]] = np.load(path, mmap_mode="r")
+
+    # Without copy=False, pandas would copy the memory-mapped columns.
+    return pd.DataFrame(data, copy=False)
+
+
+def read_pin(pin_files, group_column=None) -> mokapot.LinearPsmDataset:
+    """
+    Read PIN files into a mokapot dataset using their columnar caches.
+
+    This is a drop-in replacement for ``mokapot.read_pin()`` that reads
+    each PIN file from its cache, building the cache the first time.
+
+    Parameters
+    ----------
+    pin_files : str or list of str
+        The PIN files to read. Multiple files are concatenated.
+    group_column : str, optional
+        A column defining groups for confidence estimation.
+
+    Returns
+    -------
+    mokapot.LinearPsmDataset
+        The PSMs.
+    """
+    if isinstance(pin_files, str):
+        pin_files = [pin_files]
+
+    psms = pd.concat([read_cache(f) for f in pin_files], ignore_index=True)
+    return mokapot.read_pin(psms, group_column=group_column)
+
+
+def read_text(pin_file, chunk_rows=CHUNK_ROWS) -> pd.DataFrame:
+    """
+    Parse a PIN file as text, without using its cache.
+
+    Parameters
+    ----------
+    pin_file : str
+        The PIN file, which may be gzipped.
+    chunk_rows : int
+        The number of rows to parse at a time.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The PSMs, with the columns of the PIN file.
+    """
+    chunks = [c.apply(_to_numeric) for c in _parse_chunks(pin_file, chunk_rows)]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _parse_chunks(pin_file, chunk_rows):
+    """Split the rows of a PIN file into chunks of text columns"""
+    opener = gzip.open if pin_file.endswith(".gz") else open
+    with opener(pin_file, "rt") as pin:
+        columns = pin.readline().rstrip().split("\t")
+        reader = pd.read_csv(
+            pin,
+            sep="\x1f",
+            header=None,
+            names=["line"],
+            dtype=str,
+            quoting=csv.QUOTE_NONE,
+            chunksize=chunk_rows,
+        )
+
+        for chunk in reader:
+            chunk = chunk["line"].str.rstrip().str.split("\t", n=len(columns) - 1)
+            chunk = pd.DataFrame(chunk.tolist(), columns=columns)
+            yield chunk.loc[chunk.iloc[:, 0].str.lower() != "defaultdirection", :]
+
+
+def _to_numeric(values):
+    """Convert a column to numbers, unless it is text"""
+    try:
+        return pd.to_numeric(values)
+    except (ValueError, TypeError):
+        return values
+
+
+def _source_info(pin_file):
+    """The size and modification time of a PIN file, to detect changes"""
+    stat = os.stat(pin_file)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _column_kinds(chunk):
+    """Determine whether each column is text or numeric"""
+    kinds = {}
+    for col in chunk.columns:
+        if col.lower() in TEXT_COLUMNS:
+            kinds[col] = "str"
+        elif pd.api.types.is_numeric_dtype(_to_numeric(chunk[col])):
+            kinds[col] = "float"
+        else:
+            kinds[col] = "str"
+
+    return kinds
+
+
+def _column_file(col, kind):
+    """The file name of a cached column"""
+    col = "".join(c if c.isalnum() or c in "-_" else "_" for c in col)
+    return col + (".txt" if kind == "str" else ".npy")
+
+
+def _open_column(out_dir, col, kind):
+    """Open the file that a column is written to while parsing"""
+    path = os.path.join(out_dir, _column_file(col, kind))
+    if kind == "str":
+        return open(path, "w")
+
+    return open(path + ".tmp", "wb")
+
+
+def _text_column(out_dir, col, raw, integral):
+    """Convert the values written so far of a numeric column to text"""
+    raw.close()
+    values = np.fromfile(raw.name, float)
+    os.remove(raw.name)
+    text = open(os.path.join(out_dir, _column_file(col, "str")), "w")
+    values = [
+        "" if np.isnan(v) else str(int(v)) if integral else repr(v)
+        for v in values.tolist()
+    ]
+    if values:
+        text.write("\n".join(values) + "\n")
+
+    return text
+
+
+def _finish_column(out_dir, col, num_psms, kind, chunk_rows=CHUNK_ROWS):
+    """Add the .npy header to the raw values of a numeric column"""
+    path = os.path.join(out_dir, _column_file(col, kind))
+    dtype = np.dtype(np.int64 if kind == "int" else float)
+    header = {
+        "descr": dtype.str,
+        "fortran_order": False,
+        "shape": (num_psms,),
+    }
+    with open(path, "wb") as out, open(path + ".tmp", "rb") as raw:
+        np.lib.format.write_array_header_1_0(out, header)
+        if kind == "float":
+            shutil.copyfileobj(raw, out)
+        else:
+            values = np.fromfile(raw, float, chunk_rows)
+            while values.size:
+                out.write(values.astype(dtype).tobytes())
+                values = np.fromfile(raw, float, chunk_rows)
+
+    os.remove(path + ".tmp")
@@ -0,0 +1,202 @@
+"""
+A partitioned, columnar store of mokapot results.
+
+The PSMs, peptides, and proteins of each PIN file are saved as Parquet
+files as soon as they are scored, partitioned by the model that scored
+them and by the PIN file:
+
+    <root>/<level>/model=<model>/pin_file=<pin file>/part-0.parquet
+
+The partition values are URI encoded, as in Hive. Because the model and the
+PIN file are stored in the paths, nothing has to be added to the tables,
+and no tables are concatenated when writing. Readers scan only the
+partitions and columns they ask for.
+"""
+import os
+import shutil
+import tempfile
+import urllib.parse
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+LEVELS = ("psms", "peptides", "proteins")
+PARTITIONS = pa.schema([("model", pa.string()), ("pin_file", pa.string())])
+
+
+def partition_dir(root, level, model, pin_file=None) -> str:
+    """
+    The directory of a model's results, or those of one of its PIN files.
+
+    Parameters
+    ----------
+    root : str
+        The result store.
+    level : str
+        One of ``LEVELS``.
+    model : str
+        The model.
+    pin_file : str, optional
+        The PIN file.
+
+    Returns
+    -------
+    str
+        The directory.
+    """
+    out_dir = os.path.join(root, level, "model=" + _quote(model))
+    if pin_file is not None:
+        out_dir = os.path.join(out_dir, "pin_file=" + _quote(pin_file))
+
+    return out_dir
+
+
+def model_dirs(root, model) -> list:
+    """
+    The directories of a model's results at every level.
+
+    Parameters
+    ----------
+    root : str
+        The result store.
+    model : str
+        The model.
+
+    Returns
+    -------
+    list of str
+        The directory for each of ``LEVELS``.
+    """
+    return [partition_dir(root, level, model) for level in LEVELS]
+
+
+def clear(root, model):
+    """
+    Remove the results of a model.
+
+    Parameters
+    ----------
+    root : str
+        The result store.
+    model : str
+        The model.
+    """
+    for model_dir in model_dirs(root, model):
+        shutil.rmtree(model_dir, ignore_errors=True)
+
+
+def write(root, model, pin_file, tables):
+    """
+    Save the results of one PIN file.
+
+    Parameters
+    ----------
+    root : str
+        The result store.
+    model : str
+        The model that scored the PSMs.
+    pin_file : str
+        The PIN file.
+    tables : tuple of pandas.DataFrame
+        The PSMs, peptides, and proteins, as from a mokapot confidence
+        object. Missing levels may be None.
+    """
+    for level, table in zip(LEVELS, tables):
+        if table is None:
+            continue
+
+        out_dir = partition_dir(root, level, model, pin_file)
+        os.makedirs(out_dir, exist_ok=True)
+        out_file = os.path.join(out_dir, "part-0.parquet")
+        # Hidden, so that readers skip it, and unique to this thread.
+        fd, tmp_file = tempfile.mkstemp(suffix=".tmp", prefix=".part-", dir=out_dir)
+        with os.fdopen(fd, "wb") as out:
+            pq.write_table(pa.Table.from_pandas(table, preserve_index=False), out)
+
+        os.replace(tmp_file, out_file)
+
+
+def models(root, level="psms") -> list:
+    """
+    The models with results in the store.
+
+    Parameters
+    ----------
+    root : str
+        The result store.
+    level : str
+        One of ``LEVELS``.
+
+    Returns
+    -------
+    list of str
+        The models, sorted.
+    """
+    try:
+        names = os.listdir(os.path.join(root, level))
+    except FileNotFoundError:
+        return []
+
+    return sorted(
+        urllib.parse.unquote(n[len("model=") :])
+        for n in names
+        if n.startswith("model=")
+    )
+
+
+def read(root, level="psms", columns=None, models=None, pin_files=None, filter=None):
+    """
+    Read results, scanning only the partitions and columns that are needed.
+
+    Parameters
+    ----------
+    root : str
+        The result store.
+    level : str
+        One of ``LEVELS``.
+    columns : list of str, optional
+        The columns to read. The ``model`` and ``pin_file`` columns are
+        always included. By default, all columns are read.
+    models : list of str, optional
+        Read only the results of these models.
+    pin_files : list of str, optional
+        Read only the results of these PIN files.
+    filter : pyarrow.dataset.Expression, optional
+        A condition on the rows, such as
+        ``pyarrow.dataset.field("mokapot q-value") <= 0.01``. Row groups
+        that cannot match are skipped using the Parquet statistics.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The results.
+    """
+    dataset = ds.dataset(
+        os.path.join(root, level),
+        format="parquet",
+        partitioning=ds.partitioning(PARTITIONS, flavor="hive"),
+        exclude_invalid_files=True,
+    )
+
+    conditions = [] if filter is None else [filter]
+    if models is not None:
+        conditions.append(ds.field("model").isin(list(models)))
+
+    if pin_files is not None:
+        conditions.append(ds.field("pin_file").isin(list(pin_files)))
+
+    expr = None
+    for cond in conditions:
+        expr = cond if expr is None else expr & cond
+
+    if columns is not None:
+        columns = [c for c in columns if c not in PARTITIONS.names]
+        columns += PARTITIONS.names
+
+    return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+
+def _quote(value):
+    """URI encode a partition value"""
+    return urllib.parse.quote(str(value), safe="")
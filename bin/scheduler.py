@@ -0,0 +1,202 @@
+"""
+Run independent jobs concurrently within CPU and memory budgets.
+
+Each job is given its own set of cores that no other running job shares,
+along with an estimate of the memory it needs. Jobs are started in the
+order they were submitted whenever enough cores and memory are free, and
+jobs that must not share the machine can be marked as exclusive.
+"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future
+
+import psutil
+
+
+class Scheduler:
+    """
+    Run jobs concurrently on disjoint sets of cores.
+
+    Parameters
+    ----------
+    cpus : list of int, optional
+        The cores that jobs may use. By default, these are the cores that
+        this process is allowed to run on.
+    memory : float, optional
+        The memory budget in MB. By default, this is the memory currently
+        available.
+
+    Attributes
+    ----------
+    records : list of dict
+        The name, cores, memory estimate, start and end times, and the
+        names of other jobs that ran at the same time, for each finished
+        job.
+    """
+
+    def __init__(self, cpus=None, memory=None):
+        """Initialize a Scheduler"""
+        if cpus is None:
+            cpus = os.sched_getaffinity(0)
+
+        if memory is None:
+            memory = psutil.virtual_memory().available / 1e6
+
+        self.cpus = sorted(cpus)
+        self.memory = memory
+        self.records = []
+        self._free_cpus = list(self.cpus)
+        self._free_memory = memory
+        self._pending = []
+        self._running = {}
+        self._submitted = 0
+        self._lock = threading.Lock()
+
+    def submit(
+        self, func, *args, name=None, cores=1, memory=0, exclusive=False, **kwargs
+    ):
+        """
+        Submit a job.
+
+        The job is called as ``func(*args, cpus=cpus, **kwargs)``, where
+        ``cpus`` is the list of cores it was given. It is responsible for
+        running its work on those cores.
+
+        Parameters
+        ----------
+        func : callable
+            The job to run.
+        *args : tuple
+            Positional arguments passed to the job.
+        name : str, optional
+            The name of the job in the records.
+        cores : int
+            The number of cores the job needs.
+        memory : float or callable, optional
+            The memory the job needs in MB. If callable, it is called with
+            no arguments when the job is ready to start, so that it can use
+            the results of earlier jobs. If it returns None, the memory is
+            unknown and the job waits until it can run alone.
+        exclusive : bool
+            Run the job with no other jobs running?
+        **kwargs : dict
+            Keyword arguments passed to the job.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            The result of the job.
+        """
+        if cores > len(self.cpus):
+            logging.warning(
+                "%s requested %i cores, but only %i are available.",
+                name,
+                cores,
+                len(self.cpus),
+            )
+            cores = len(self.cpus)
+
+        job = {
+            "name": name if name is not None else f"job{self._submitted}",
+            "func": func,
+            "args": args,
+            "kwargs": kwargs,
+            "cores": cores,
+            "memory": memory,
+            "exclusive": exclusive,
+            "future": Future(),
+        }
+
+        with self._lock:
+            self._submitted += 1
+            self._pending.append(job)
+            self._dispatch()
+
+        return job["future"]
+
+    def _dispatch(self):
+        """Start every pending job that fits. The lock must be held."""
+        for job in list(self._pending):
+            if any(j["exclusive"] for j in self._running.values()):
+                return
+
+            if job["exclusive"]:
+                if self._running:
+                    return  # Don't let later jobs starve it.
+
+                memory = self._memory(job)
+            else:
+                memory = self._memory(job)
+                if memory is None:
+                    if self._running:
+                        continue
+
+                    job["exclusive"] = True
+
+                elif memory > self._free_memory and self._running:
+                    continue
+
+                if job["cores"] > len(self._free_cpus):
+                    continue
+
+            self._pending.remove(job)
+            self._start(job, memory if memory is not None else self._free_memory)
+
+    def _memory(self, job):
+        """Evaluate the memory estimate of a job"""
+        if callable(job["memory"]):
+            return job["memory"]()
+
+        return job["memory"]
+
+    def _start(self, job, memory):
+        """Reserve resources and start a job. The lock must be held."""
+        cpus = self._free_cpus[: job["cores"]]
+        del self._free_cpus[: job["cores"]]
+        self._free_memory -= memory
+
+        record = {
+            "name": job["name"],
+            "cpus": cpus,
+            "memory": memory,
+            "exclusive": job["exclusive"],
+            "start": time.time(),
+            "concurrent": set(self._running),
+        }
+
+        for other in self._running.values():
+            other["record"]["concurrent"].add(job["name"])
+
+        job["record"] = record
+        self._running[job["name"]] = job
+        logging.debug("Starting %s on cores %s", job["name"], cpus)
+        thread = threading.Thread(target=self._run, args=(job,), daemon=True)
+        thread.start()
+
+    def _run(self, job):
+        """Run a job, release its resources, then start any that now fit"""
+        record = job["record"]
+        result = error = None
+        try:
+            result = job["func"](*job["args"], cpus=record["cpus"], **job["kwargs"])
+        except BaseException as err:
+            error = err
+
+        with self._lock:
+            record["end"] = time.time()
+            record["concurrent"] = sorted(record["concurrent"])
+            self.records.append(record)
+            del self._running[job["name"]]
+            self._free_cpus = sorted(self._free_cpus + record["cpus"])
+            self._free_memory += record["memory"]
+
+        # Callbacks run before dispatching, so they may inform estimates.
+        if error is not None:
+            job["future"].set_exception(error)
+        else:
+            job["future"].set_result(result)
+
+        with self._lock:
+            self._dispatch()
@@ -1,13 +1,31 @@
 """
 Python wrappers for various search engines and utilities.
+
+Each wrapper runs its tool to completion, without a shell, and can record
+the resources it used as one step of a pipeline. To run many of them at
+once, submit them to a JobRunner, which gives each job its own cores and
+counts its memory against a budget.
 """
 import os
-import shutil
+import re
+import json
+import time
+import fcntl
+import inspect
+import functools
 import subprocess
-from tempfile import TemporaryDirectory
 
+import fasta as fasta_
+import monitor
+import scheduler
+
+# The number of bytes for each suffix of java -Xmx.
+MEMORY_UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
 
-def msfragger(ms_files, max_mem="32G", jar_path=None, **kwargs):
+
+def msfragger(
+    ms_files, max_mem="32G", jar_path=None, log_file=None, cpus=None, **kwargs
+):
     """
     Conduct a search using MSFragger.
 
@@ -19,25 +37,28 @@ def msfragger(ms_files, max_mem="32G", jar_path=None, **kwargs):
         Passed to java -Xmx
     jar_path : str
         The path to the MSFragger jar file.
+    log_file : str, optional
+        The file to which the output of MSFragger is written.
+    cpus : list of int, optional
+        The cores to run on. Unless ``num_threads`` is given, MSFragger
+        uses one thread per core.
     **kwargs : dict
         Arguments passed to MSFragger.
     """
-    if jar_path is None:
-        jar_path = os.getenv("MSFRAGGER_PATH")
-        if not jar_path:
-            jar_path = "~/bin/MSFragger-3.1.1/MSFragger-3.1.1.jar"
+    if cpus is not None:
+        kwargs.setdefault("num_threads", len(cpus))
 
-    jar_path = os.path.abspath(os.path.expanduser(jar_path))
-    fragger_args = [f"--{k} {v}" for k, v in kwargs.items()]
+    jar_path = msfragger_jar(jar_path)
+    fragger_args = _options(kwargs)
     cmd = ["java", f"-Xmx{max_mem}", "-jar", jar_path] + fragger_args
 
     if isinstance(ms_files, str):
         ms_files = [ms_files]
 
-    subprocess.run(" ".join(cmd + ms_files), check=True, shell=True)
+    run(cmd + ms_files, log_file=log_file, cpus=cpus)
 
 
-def tide(ms_files, fasta, **kwargs):
+def tide(ms_files, fasta, log_file=None, cpus=None, **kwargs):
     """
     Conduct a search using crux tide.
 
@@ -47,21 +68,42 @@ def tide(ms_files, fasta, **kwargs):
         The MS data files to search.
     fasta : str
         The protein database to search.
+    log_file : str, optional
+        The file to which the output of tide is written.
+    cpus : list of int, optional
+        The cores to run on. Unless ``num-threads`` is given, tide uses
+        one thread per core.
     **kwargs : dict
         Arguments passed to MSFragger.
     """
-    tide_args = [f"--{k} {v}" for k, v in kwargs.items()]
+    if cpus is not None:
+        kwargs.setdefault("num-threads", len(cpus))
+
+    tide_args = _options(kwargs)
     cmd = ["crux", "tide-search"] + tide_args
 
     if isinstance(ms_files, str):
         ms_files = [ms_files]
 
-    subprocess.run(" ".join(cmd + ms_files + [fasta]), check=True, shell=True)
+    run(cmd + ms_files + [fasta], log_file=log_file, cpus=cpus)
 
 
-def make_decoys(fasta, outfile, concat=True, **kwargs):
+def make_decoys(
+    fasta,
+    outfile,
+    concat=True,
+    method="reverse",
+    enzyme="trypsin",
+    decoy_prefix="decoy_",
+    log_file=None,
+    cpus=None,
+    **kwargs,
+):
     """
-    Run crux generate-peptides to create concatenated target-decoy database.
+    Create a concatenated target-decoy database.
+
+    The decoys are generated in-process, streaming the proteins through a
+    pool of workers, and the database is written in a single pass.
 
     Parameters
     ----------
@@ -71,29 +113,36 @@ def make_decoys(fasta, outfile, concat=True, **kwargs):
         The name of the resulting fasta file.
     concat : bool
         Return a concatenated database or just the decoys?
+    method : {"reverse", "shuffle"}
+        How to make the decoy of each peptide.
+    enzyme : str
+        The enzyme, whose cleavage sites are kept in place. See
+        ``fasta.ENZYMES``.
+    decoy_prefix : str
+        The prefix added to the protein ID of decoys.
+    log_file : str, optional
+        Not used, because no external tool is run. It is accepted so that
+        this can be submitted to a JobRunner.
+    cpus : list of int, optional
+        The cores to run on, with one worker per core.
     **kwargs : dict
-        Arguments passed to 'crux generate-peptides'
+        Arguments passed to ``fasta.make_decoys()``, such as ``seed``.
     """
-    with TemporaryDirectory() as tmp:
-        crux_args = [f"--{k} {v}" for k, v in kwargs.items()]
-        cmd = ["crux", "generate-peptides", "--output-dir", tmp, fasta]
-        cmd += crux_args
-
-        subprocess.run(" ".join(cmd), check=True, shell=True)
-        decoys = os.path.join(tmp, "generate-peptides.proteins.decoy.txt")
-
-        with open(outfile, "wb") as fout:
-            if concat:
-                with open(fasta, "rb") as target_file:
-                    shutil.copyfileobj(target_file, fout)
-
-            with open(decoys, "rb") as decoy_file:
-                shutil.copyfileobj(decoy_file, fout)
-
-    return outfile
+    return run_step(
+        "make-decoys",
+        fasta_.make_decoys,
+        fasta,
+        outfile,
+        concat=concat,
+        method=method,
+        enzyme=enzyme,
+        decoy_prefix=decoy_prefix,
+        cpus=cpus,
+        **kwargs,
+    )
 
 
-def tide_index(fasta_file, name, **kwargs):
+def tide_index(fasta_file, name, log_file=None, cpus=None, **kwargs):
     """
     Run crux tide-index.
 
@@ -103,11 +152,312 @@ def tide_index(fasta_file, name, **kwargs):
         The protein database
     name : str
         The name of the index directory
+    log_file : str, optional
+        The file to which the output of tide-index is written.
+    cpus : list of int, optional
+        The cores to run on.
     **kwargs : dict
         Arguments to pass to tide-index
     """
-    index_args = [f"--{k} {v}" for k, v in kwargs.items()]
+    index_args = _options(kwargs)
     cmd = ["crux", "tide-index"] + index_args
-    subprocess.run(" ".join(cmd + [fasta_file, name]), check=True, shell=True)
+    run(cmd + [fasta_file, name], log_file=log_file, cpus=cpus)
 
     return name
+
+
+def msfragger_jar(jar_path=None) -> str:
+    """
+    Find the MSFragger jar file.
+
+    Parameters
+    ----------
+    jar_path : str, optional
+        The path to the MSFragger jar file. By default, this is the
+        ``MSFRAGGER_PATH`` environment variable or, if that is unset,
+        MSFragger 3.1.1 in ``~/bin``.
+
+    Returns
+    -------
+    str
+        The absolute path to the jar file.
+    """
+    if jar_path is None:
+        jar_path = os.getenv("MSFRAGGER_PATH")
+        if not jar_path:
+            jar_path = "~/bin/MSFragger-3.1.1/MSFragger-3.1.1.jar"
+
+    return os.path.abspath(os.path.expanduser(jar_path))
+
+
+def msfragger_version(jar_path=None) -> str:
+    """
+    The version of MSFragger, for memoizing its results.
+
+    Parameters
+    ----------
+    jar_path : str, optional
+        The path to the MSFragger jar file. See ``msfragger_jar()``.
+
+    Returns
+    -------
+    str
+        The name of the jar file, which includes the version.
+    """
+    return os.path.basename(msfragger_jar(jar_path))
+
+
+@functools.lru_cache()
+def crux_version() -> str:
+    """
+    The version of crux, for memoizing its results.
+
+    Returns
+    -------
+    str
+        The version reported by ``crux version``.
+    """
+    proc = subprocess.run(
+        ["crux", "version"], check=True, capture_output=True, universal_newlines=True
+    )
+    return proc.stdout.strip()  # stderr has timestamps.
+
+
+def run(cmd, log_file=None, cpus=None, step=None, record_file=None) -> dict:
+    """
+    Run a command without a shell and record the resources it used.
+
+    A record of the step, with the wall time, CPU time, and peak RSS of
+    the process tree and any progress lines the tool printed, is appended
+    to a JSON lines file, so that every step of a pipeline can be compared.
+
+    Parameters
+    ----------
+    cmd : list of str
+        The command to run.
+    log_file : str, optional
+        The file to which stdout and stderr are appended. By default, they
+        are written to stdout.
+    cpus : list of int, optional
+        The cores to which the command and its children are restricted.
+    step : str, optional
+        The name of the step. By default, this is the crux command or the
+        name of the executable.
+    record_file : str, optional
+        The JSON lines file for the record. By default, this is the
+        ``STEP_RECORDS`` environment variable, and no record is saved if it
+        is unset.
+
+    Returns
+    -------
+    dict
+        The record, as from ``monitor.step_record()``.
+    """
+    cmd = [str(c) for c in cmd]
+    if step is None:
+        step = cmd[1] if os.path.basename(cmd[0]) == "crux" else cmd[0]
+        step = os.path.basename(step)
+
+    if log_file is None:
+        profile = monitor.run(cmd, None, cpus=cpus, check=False)
+    else:
+        with open(log_file, "a") as log:
+            profile = monitor.run(cmd, log, cpus=cpus, check=False)
+
+    record = monitor.step_record(profile, step)
+    save_record(record, record_file)
+    if profile["returncode"]:
+        raise subprocess.CalledProcessError(profile["returncode"], cmd)
+
+    return record
+
+
+def run_step(step, func, *args, record_file=None, **kwargs):
+    """
+    Run a Python function as a step and record the resources it used.
+
+    Parameters
+    ----------
+    step : str
+        The name of the step.
+    func : callable
+        The function, called as ``func(*args, **kwargs)``.
+    *args : tuple
+        Positional arguments passed to the function.
+    record_file : str, optional
+        The JSON lines file for the record. See ``run()``.
+    **kwargs : dict
+        Keyword arguments passed to the function.
+
+    Returns
+    -------
+    object
+        What the function returned.
+    """
+    start = time.time()
+    with monitor.StageTimer() as timer:
+        with timer.stage(step):
+            result = func(*args, **kwargs)
+
+    stage = timer.records[0]
+    record = {
+        "step": step,
+        "cmd": None,
+        "start": start,
+        "returncode": 0,
+        "wall_time": stage["wall_time"],
+        "cpu_time": stage["cpu_time"],
+        "max_rss": stage["max_rss"],
+        "num_samples": None,
+        "max_procs": 1,
+        "progress": [],
+    }
+    save_record(record, record_file)
+    return result
+
+
+def save_record(record, record_file=None):
+    """
+    Append a step record to a JSON lines file.
+
+    Parameters
+    ----------
+    record : dict
+        The record.
+    record_file : str, optional
+        The JSON lines file. By default, this is the ``STEP_RECORDS``
+        environment variable, and nothing is saved if it is unset.
+    """
+    if record_file is None:
+        record_file = os.getenv("STEP_RECORDS")
+        if not record_file:
+            return
+
+    with open(record_file, "a") as records:
+        fcntl.flock(records, fcntl.LOCK_EX)
+        records.write(json.dumps(record) + "\n")
+
+
+def megabytes(memory) -> float:
+    """
+    Convert an amount of memory to MB.
+
+    Parameters
+    ----------
+    memory : float or str
+        A number of MB, or a string like those given to java -Xmx, such as
+        ``"32G"``. The suffixes are powers of 1024 and no suffix is bytes.
+
+    Returns
+    -------
+    float
+        The memory in MB.
+    """
+    if not isinstance(memory, str):
+        return float(memory)
+
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)B?\s*", memory.upper())
+    if match is None:
+        raise ValueError(f"Unrecognized amount of memory: {memory}")
+
+    return float(match.group(1)) * MEMORY_UNITS[match.group(2)] / 1e6
+
+
+class JobRunner:
+    """
+    Run search jobs concurrently within CPU and memory budgets.
+
+    Jobs are functions like the wrappers in this module, which accept
+    ``log_file`` and ``cpus`` keyword arguments. Each is run on its own
+    set of cores, with its output written to its own log, once enough
+    cores and memory are free.
+
+    Parameters
+    ----------
+    threads : int, optional
+        The number of cores to use. By default, all of the cores that this
+        process may run on are used.
+    memory : float or str, optional
+        The memory budget, as for ``megabytes()``. By default, this is the
+        memory currently available.
+    log_dir : str
+        The directory for the log of each job.
+    """
+
+    def __init__(self, threads=None, memory=None, log_dir="logs"):
+        """Initialize a JobRunner"""
+        cpus = sorted(os.sched_getaffinity(0))
+        if threads is not None:
+            cpus = cpus[:threads]
+
+        if memory is not None:
+            memory = megabytes(memory)
+
+        self.log_dir = log_dir
+        self._submitted = 0
+        self._scheduler = scheduler.Scheduler(cpus, memory)
+
+    @property
+    def records(self):
+        """The cores, memory, and timing of each finished job"""
+        return self._scheduler.records
+
+    def submit(self, func, *args, name=None, threads=1, memory=None, **kwargs):
+        """
+        Submit a job.
+
+        Parameters
+        ----------
+        func : callable
+            The job, such as ``tide``, called as
+            ``func(*args, log_file=log_file, cpus=cpus, **kwargs)``.
+        *args : tuple
+            Positional arguments passed to the job.
+        name : str, optional
+            The name of the job, which is also the name of its log.
+        threads : int
+            The number of cores the job needs.
+        memory : float or str, optional
+            The memory the job needs, as for ``megabytes()``. By default,
+            this is the ``max_mem`` of the job, such as the Java heap of
+            MSFragger, or zero if it has none.
+        **kwargs : dict
+            Keyword arguments passed to the job.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            The result of the job.
+        """
+        if memory is None:
+            memory = kwargs.get("max_mem", _default(func, "max_mem", 0))
+
+        self._submitted += 1
+        if name is None:
+            name = f"{func.__name__}_{self._submitted}"
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        return self._scheduler.submit(
+            func,
+            *args,
+            name=name,
+            cores=threads,
+            memory=megabytes(memory),
+            log_file=os.path.join(self.log_dir, f"{name}.log"),
+            **kwargs,
+        )
+
+
+def _options(kwargs):
+    """Convert keyword arguments to command line options"""
+    return [str(x) for k, v in kwargs.items() for x in (f"--{k}", v)]
+
+
+def _default(func, arg, value):
+    """The default value of a function argument, if it has one"""
+    try:
+        default = inspect.signature(func).parameters[arg].default
+    except (KeyError, TypeError, ValueError):
+        return value
+
+    return value if default is inspect.Parameter.empty else default
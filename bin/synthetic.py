@@ -0,0 +1,210 @@
+"""
+Generate synthetic PIN files for benchmarking.
+
+The PSMs mimic a concatenated target-decoy search processed by crux
+make-pin: decoys and incorrect target PSMs share one distribution of
+features and correct target PSMs another, with charge one-hot columns,
+peptides, and one or more proteins per PSM. Rows are generated and written
+in chunks, so files of any size can be made with constant memory.
+"""
+import csv
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+
+AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+CHARGE_PROBS = {1: 0.05, 2: 0.5, 3: 0.35, 4: 0.08, 5: 0.02}
+CHUNK_SIZE = 10 ** 6
+MAX_LENGTH = 50
+SEP = "\x1f"  # Replaced with tabs between protein IDs when writing.
+
+
+def write_pin(
+    out_file,
+    num_psms,
+    decoy_fraction=0.4,
+    correct_fraction=0.4,
+    charges=(1, 2, 3, 4, 5),
+    num_proteins=20000,
+    max_proteins=3,
+    groups=None,
+    decoy_prefix="decoy_",
+    chunk_size=CHUNK_SIZE,
+    seed=42,
+):
+    """
+    Write a synthetic PIN file.
+
+    Parameters
+    ----------
+    out_file : str
+        The PIN file to create.
+    num_psms : int
+        The number of PSMs to generate.
+    decoy_fraction : float
+        The expected fraction of PSMs that are decoys.
+    correct_fraction : float
+        The expected fraction of target PSMs that are correct.
+    charges : tuple of int
+        The possible charge states, each of which gets a one-hot column.
+    num_proteins : int
+        The number of proteins to draw protein IDs from.
+    max_proteins : int
+        The maximum number of proteins for a PSM.
+    groups : dict of str, float, optional
+        Add a "group" column as the first column, like the PIN files in
+        ``scripts/rna-xl``. The keys are the groups and the values are
+        their relative frequencies.
+    decoy_prefix : str
+        The prefix for decoy protein IDs.
+    chunk_size : int
+        The number of PSMs to generate at a time.
+    seed : int
+        The random seed.
+
+    Returns
+    -------
+    str
+        The PIN file.
+    """
+    rng = np.random.default_rng(seed)
+    logging.info("Writing %i synthetic PSMs to %s...", num_psms, out_file)
+    proteins = np.array([f"sp|SYN{i:06d}|SYN{i}_HUMAN" for i in range(num_proteins)])
+    proteins = np.stack([proteins, np.char.add(decoy_prefix, proteins)])
+
+    probs = np.array([CHARGE_PROBS.get(c, 0.01) for c in charges])
+    probs /= probs.sum()
+    if groups is not None:
+        group_probs = np.array(list(groups.values()), dtype=float)
+        groups = np.array(list(groups.keys()))
+        group_probs /= group_probs.sum()
+
+    with open(out_file, "w") as pin:
+        for start in range(0, num_psms, chunk_size):
+            size = min(chunk_size, num_psms - start)
+            chunk = _make_chunk(
+                rng,
+                start,
+                size,
+                decoy_fraction,
+                correct_fraction,
+                np.array(charges),
+                probs,
+                proteins,
+                max_proteins,
+            )
+
+            if groups is not None:
+                chunk.insert(0, "group", rng.choice(groups, size, p=group_probs))
+
+            text = chunk.round(5).to_csv(
+                sep="\t", index=False, header=not start, quoting=csv.QUOTE_NONE
+            )
+            pin.write(text.replace(SEP, "\t"))
+
+    return out_file
+
+
+def _make_chunk(
+    rng, start, size, decoy_frac, correct_frac, charges, probs, proteins, max_prot
+):
+    """Generate a chunk of PSMs as a DataFrame"""
+    decoy = rng.random(size) < decoy_frac
+    correct = ~decoy & (rng.random(size) < correct_frac)
+    charge = rng.choice(charges, size, p=probs)
+    length = np.clip(rng.poisson(9, size) + 6, 6, MAX_LENGTH)
+    mass = length * 110.5 + rng.normal(0, 50, size)
+    delta = np.where(
+        correct, rng.normal(0, 0.005, size), rng.uniform(-0.05, 0.05, size)
+    )
+    deltcn = np.where(correct, rng.beta(3, 6, size), rng.beta(1, 12, size))
+
+    df = pd.DataFrame(
+        {
+            "SpecId": [f"synthetic_{i}" for i in range(start, start + size)],
+            "Label": np.where(decoy, -1, 1),
+            "ScanNr": np.arange(start, start + size) + 1,
+            "ExpMass": mass + delta,
+            "lnrSp": np.where(
+                correct,
+                np.log(rng.integers(1, 6, size)),
+                np.log(rng.integers(1, 500, size)),
+            ),
+            "deltLCn": deltcn + (1 - deltcn) * rng.beta(2, 5, size),
+            "deltCn": deltcn,
+            "XCorr": np.where(
+                correct,
+                np.clip(rng.normal(2.5, 0.7, size), 0, None),
+                rng.gamma(4, 0.25, size),
+            ),
+            "Sp": np.where(
+                correct,
+                np.clip(rng.normal(400, 150, size), 0, None),
+                rng.gamma(2, 60, size),
+            ),
+            "IonFrac": np.where(correct, rng.beta(6, 4, size), rng.beta(2, 8, size)),
+            "Mass": mass,
+            "PepLen": length,
+        }
+    )
+
+    for val in charges:
+        df[f"Charge{val}"] = (charge == val).astype(int)
+
+    df["enzN"] = (rng.random(size) < np.where(correct, 0.98, 0.9)).astype(int)
+    df["enzC"] = (rng.random(size) < np.where(correct, 0.98, 0.9)).astype(int)
+    df["enzInt"] = rng.poisson(np.where(correct, 0.3, 0.5))
+    df["lnNumSP"] = rng.normal(8, 1, size)
+    df["dM"] = delta
+    df["absdM"] = np.abs(delta)
+    df["Peptide"] = _peptides(rng, length)
+
+    # Multiple proteins are separated by tabs, like in crux make-pin output.
+    num = rng.integers(1, max_prot + 1, size)
+    idx = rng.integers(0, proteins.shape[1], (size, max_prot))
+    prots = proteins[decoy.astype(int)[:, None], idx].astype(object)
+    df["Proteins"] = prots[:, 0]
+    for col in range(1, max_prot):
+        df["Proteins"] = np.where(
+            num > col, df["Proteins"] + SEP + prots[:, col], df["Proteins"]
+        )
+
+    return df
+
+
+def _peptides(rng, length):
+    """Generate random tryptic peptides with flanking residues"""
+    seqs = AMINO_ACIDS[rng.integers(0, len(AMINO_ACIDS), (len(length), MAX_LENGTH))]
+    ends = np.array([ord("K"), ord("R")], dtype=np.uint8)
+    seqs[np.arange(len(length)), length - 1] = ends[rng.integers(0, 2, len(length))]
+    seqs[np.arange(MAX_LENGTH)[None, :] >= length[:, None]] = 0
+    seqs = np.ascontiguousarray(seqs).view(f"S{MAX_LENGTH}").ravel()
+    seqs = np.char.decode(seqs, "ascii").astype(object)
+    return "-." + seqs + ".-"
+
+
+def main():
+    """Write a synthetic PIN file from the command line"""
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("out_file", help="The PIN file to create.")
+    parser.add_argument("num_psms", type=int, help="The number of PSMs.")
+    parser.add_argument("--seed", type=int, default=42, help="The random seed.")
+    parser.add_argument(
+        "--groups",
+        nargs="+",
+        help="Add a group column with these groups, in equal proportions.",
+    )
+    args = parser.parse_args()
+
+    groups = None
+    if args.groups:
+        groups = {g: 1 for g in args.groups}
+
+    write_pin(args.out_file, args.num_psms, groups=groups, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,114 +2,558 @@
 Benchmark Percolator and mokapot
 """
 import os
+import gzip
+import json
+import shutil
 import logging
-import subprocess
+import sys
+import argparse
+import functools
+import multiprocessing
 
-import tqdm
 import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join("..", "..", "bin"))
+import history
+import monitor
+import pinfile
+import scheduler
+import synthetic
 
 # Setup -----------------------------------------------------------------------
+# Each configuration is repeated at least REPS and at most MAX_REPS times,
+# until the 95% confidence intervals of its time and memory are within
+# CI_WIDTH of their means. All runs are recorded in HISTORY.
 REPS = 3
+MAX_REPS = 10
+CI_WIDTH = 0.05
+HISTORY = "history.sqlite"
 PIN = os.path.join(os.getenv("TMPDIR"), "test.pin")
-LENGTH = 23330312
+
+# The environment variables that limit the threads of each tool:
+THREAD_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+# For running benchmarks concurrently: runs with at least ISOLATE PSMs are run
+# alone and memory estimates are inflated by MEMORY_MARGIN.
+ISOLATE = 10 ** 6
+MEMORY_MARGIN = 1.5
+
+# The ways of reading a PIN file to compare:
+LOADERS = ["text", "gzip", "cache"]
+
+# Where each stage begins in the Percolator log. Writing the results is not
+# logged, so it is included in the last stage.
+PERCOLATOR_STAGES = [
+    ("read_pin", None),
+    ("train", r"^Train/test set contains"),
+    ("assign_confidence", r"^Calculating q values"),
+]
 
 # Functions -------------------------------------------------------------------
-def get_results(log_file):
-    """Extract the wall clock time and maximum RSS from a GNU time log file"""
-    with open(log_file) as log:
-        for line in log:
-            if "Elapsed (wall clock) time" in line:
-                time = line.split(" ")[-1].split(":")
-                if len(time) == 3:
-                    time = (
-                        float(time[0]) * 60 ** 2 + float(time[1]) * 60 + float(time[2])
-                    )
-                else:
-                    time = float(time[0]) * 60 + float(time[1])
-            if "Maximum resident set size" in line:
-                mem = float(line.split(" ")[-1]) / 1000
-
-    return (time, mem)
-
-
-def sample_psms(num, pin_file, out_file, total):
-    """Sample PSMs"""
-    if os.path.isfile(out_file):
-        return out_file
+def get_results(profile_file):
+    """Extract the wall clock time and maximum RSS from a profile"""
+    profile = monitor.load_profile(profile_file)
+    return (profile["wall_time"], profile["max_rss"])
 
-    psm_set = set(np.random.choice(np.arange(total), num, replace=False))
 
-    logging.info(f"Sampling {num} PSMs...")
-    # Read through PIN, appending selected rows to the list.
-    samp = []
-    with open(pin_file, "r") as pin:
-        samp.append(pin.readline())
+def sample_psms(nums, pin_file, out_files, seed=42):
+    """Sample nested subsets of PSMs from a PIN file.
 
-        for idx, psm in tqdm.tqdm(enumerate(pin), total=total):
-            if idx in psm_set:
-                samp.append(psm)
+    A single random sample of the PSMs is drawn and each subset is a
+    prefix of it, so every smaller subset is contained in the larger ones.
+    The rows for each subset are then read by seeking with the line offset
+    index of the PIN file, rather than iterating over the whole file.
 
-    with open(out_file, "w+") as out_pin:
-        out_pin.writelines(samp)
+    Parameters
+    ----------
+    nums : list of int
+        The number of PSMs in each subset.
+    pin_file : str
+        The PIN file to sample from.
+    out_files : list of str
+        The output PIN file for each subset.
+    seed : int
+        The random seed for sampling.
 
-    return out_file
+    Returns
+    -------
+    list of str
+        The sampled PIN files.
+    """
+    offsets = pinfile.load_index(pin_file)
+    total = len(offsets) - 1
+    if max(nums) > total:
+        raise ValueError("Cannot sample more PSMs than are in the PIN file.")
+
+    # Always draw the sample so that re-runs stay nested:
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(total, max(nums), replace=False)
+
+    for num, out_file in zip(nums, out_files):
+        if os.path.isfile(out_file):
+            continue
 
+        logging.info("Sampling %i PSMs...", num)
+        pinfile.write_rows(pin_file, rows[:num], out_file, offsets)
 
-def benchmark(pin, mokapot=True, rep=None):
-    """Benchmark a command"""
-    prefix = ["/usr/bin/time", "-v"]
-    suffix = [pin, "2>"]
+    return out_files
 
+
+def benchmark(pin, mokapot=True, rep=None, threads=None, cpus=None, dest="profiles"):
+    """Benchmark a command, optionally limiting its threads and cores"""
     if rep is None:
         rep = ""
     else:
         rep = f"_{rep}"
 
-    fileroot = os.path.split(pin)[-1].replace(".pin", f"{rep}.log.txt")
+    fileroot = os.path.split(pin)[-1].replace(".pin", "")
+    if threads is not None:
+        fileroot += f"_t{threads}"
+
+    fileroot += rep
     out_dir = os.getenv("TMPDIR")
 
     if mokapot:
-        out_file = [f"logs/mokapot_{fileroot}"]
-        cmd = [f"mokapot -d {out_dir}"]
+        tool = "mokapot"
+        cmd = ["mokapot", "-d", out_dir, pin]
     else:
-        out_file = [f"logs/percolator_{fileroot}"]
+        tool = "percolator"
         cmd = [
-            f"percolator -Y --results-psms {out_dir}/percolator.psms.txt "
-            f"--results-peptides {out_dir}/percolator.peptides.txt"
+            "percolator",
+            "-Y",
+            "--results-psms",
+            f"{out_dir}/percolator.psms.txt",
+            "--results-peptides",
+            f"{out_dir}/percolator.peptides.txt",
+            pin,
         ]
 
-    if not os.path.isfile(out_file[0]):
-        logging.info(f"Running {cmd[0]} on {pin}")
-        subprocess.run(
-            " ".join(prefix + cmd + suffix + out_file), shell=True, check=True
+    log_dir = "logs" if dest == "profiles" else f"logs/{dest}"
+    log_file = f"{log_dir}/{tool}_{fileroot}.log.txt"
+    out_file = f"{dest}/{tool}_{fileroot}.json"
+    env = None
+    if threads is not None:
+        env = dict(os.environ, **{v: str(threads) for v in THREAD_VARS})
+        if mokapot:
+            cmd[1:1] = ["--max_workers", str(threads)]
+
+    if not os.path.isfile(out_file):
+        logging.info(f"Running {tool} on {pin}")
+        monitor.run(cmd, log_file, out_file, cpus=cpus, env=env)
+    else:
+        logging.info(f"{out_file} exist. Skipping...")
+
+    return out_file
+
+
+def execute(runs, dest, concurrent=None):
+    """Run benchmarks one after another or concurrently"""
+    if concurrent:
+        order = sorted(range(len(runs)), key=lambda i: runs[i]["psms"])
+        profiles = run_concurrent([runs[i] for i in order], dest)
+        return [p for _, p in sorted(zip(order, profiles))]
+
+    return [
+        benchmark(r["pin"], r["tool"] == "mokapot", r["rep"], r["threads"], dest=dest)
+        for r in runs
+    ]
+
+
+def tabulate(runs, profiles, dataset="sampled"):
+    """Collect the version, time, and memory of each run, flagging outliers"""
+    res = []
+    for run, prof_file in zip(runs, profiles):
+        profile = monitor.load_profile(prof_file)
+        lines = [line for _, line in profile["lines"]]
+        res.append(
+            {
+                "dataset": dataset,
+                "tool": run["tool"],
+                "version": history.tool_version(lines, run["tool"]),
+                "psms": run["psms"],
+                "threads": run["threads"],
+                "rep": run["rep"],
+                "start": profile["start"],
+                "wall_time": profile["wall_time"],
+                "max_rss": profile["max_rss"],
+                "profile": prof_file,
+            }
+        )
+
+    res = pd.DataFrame(res)
+    groups = res.groupby(["tool", "psms", "threads"], dropna=False)
+    res["outlier"] = groups["wall_time"].transform(history.outliers).astype(bool)
+    res["outlier"] |= groups["max_rss"].transform(history.outliers).astype(bool)
+    return res
+
+
+def more_reps(runs, profiles):
+    """Add a replicate of each configuration that isn't yet precise enough"""
+    res = tabulate(runs, profiles)
+    extra = []
+    for (tool, num, _), grp in res.groupby(["tool", "psms", "threads"], dropna=False):
+        if len(grp) >= MAX_REPS:
+            continue
+
+        if history.converged(grp["wall_time"], grp["max_rss"], CI_WIDTH, REPS):
+            continue
+
+        extra.append({**runs[grp.index[0]], "rep": int(grp["rep"].max()) + 1})
+        logging.info("Adding replicate %i of %s with %i PSMs.", len(grp), tool, num)
+
+    return extra
+
+
+def run_concurrent(runs, dest):
+    """Run benchmarks concurrently on disjoint sets of cores.
+
+    Each run is pinned to as many cores as it has threads. The memory of
+    each run is estimated from the peak RSS of the largest run of the same
+    tool that has finished with no more PSMs, and runs with at least
+    ISOLATE PSMs are run alone. The cores and the other runs sharing the
+    machine are recorded for each run in logs/{dest}.schedule.json.
+
+    Parameters
+    ----------
+    runs : list of dict
+        The tool, number of PSMs, PIN file, replicate, and threads of each
+        run.
+    dest : str
+        The directory for the profiles.
+
+    Returns
+    -------
+    list of str
+        The profile of each run.
+    """
+    sched = scheduler.Scheduler()
+    measured = {}
+
+    def record(tool, num, future):
+        """Save the peak RSS of a finished run"""
+        if future.exception() is None:
+            _, mem = get_results(future.result())
+            measured[(tool, num)] = max(mem, measured.get((tool, num), 0))
+
+    futures = []
+    for run in runs:
+        tool, num = run["tool"], run["psms"]
+        future = sched.submit(
+            benchmark,
+            run["pin"],
+            tool == "mokapot",
+            run["rep"],
+            run["threads"],
+            dest=dest,
+            name=f"{tool}_{num}_t{run['threads']}_{run['rep']}",
+            cores=run["threads"],
+            memory=functools.partial(estimate_memory, tool, num, measured),
+            exclusive=num >= ISOLATE,
         )
+        future.add_done_callback(functools.partial(record, tool, num))
+        futures.append(future)
+
+    profiles = [f.result() for f in futures]
+    with open(f"logs/{dest}.schedule.json", "w") as out:
+        json.dump(sched.records, out)
+
+    return profiles
+
+
+def estimate_memory(tool, num, measured):
+    """Extrapolate the peak RSS of a run from the nearest smaller one"""
+    smaller = [(n, m) for (t, n), m in measured.items() if t == tool and n <= num]
+    if not smaller:
+        return None
+
+    size, mem = max(smaller)
+    return mem * num / size * MEMORY_MARGIN
+
+
+def scaling_table(runs):
+    """Calculate the speedup and parallel efficiency for a thread sweep.
+
+    The best time and memory across replicates is used for each
+    configuration, and speedup is relative to the fewest threads tested.
+
+    Parameters
+    ----------
+    runs : list of dict
+        The tool, number of PSMs, threads, and profile file of each run.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The time, memory, speedup, and efficiency for each tool, number of
+        PSMs, and number of threads.
+    """
+    res = []
+    for run in runs:
+        time, mem = get_results(run["profile"])
+        res.append({**run, "time": time, "mem": mem})
+
+    keys = ["tool", "psms", "threads"]
+    res = pd.DataFrame(res).groupby(keys)[["time", "mem"]].min().reset_index()
+    base = res.sort_values("threads").groupby(["tool", "psms"]).head(1)
+    base = base.rename(columns={"threads": "base_threads", "time": "base_time"})
+    res = pd.merge(res, base.loc[:, ["tool", "psms", "base_threads", "base_time"]])
+    res["speedup"] = res["base_time"] / res["time"]
+    res["efficiency"] = res["speedup"] * res["base_threads"] / res["threads"]
+    return res.drop(columns=["base_threads", "base_time"])
+
+
+def benchmark_stages(pin, rep=None):
+    """Benchmark each stage of mokapot using its Python API"""
+    if rep is None:
+        rep = ""
     else:
-        logging.info(f"{out_file[0]} exist. Skipping...")
+        rep = f"_{rep}"
+
+    fileroot = os.path.split(pin)[-1].replace(".pin", rep)
+    out_file = f"stages/mokapot_{fileroot}.json"
+    if os.path.isfile(out_file):
+        logging.info(f"{out_file} exist. Skipping...")
+        return out_file
+
+    # Use a fresh process so that memory from previous runs isn't counted.
+    logging.info(f"Running mokapot stages on {pin}")
+    ctx = multiprocessing.get_context("spawn")
+    proc = ctx.Process(target=brew_stages, args=(pin, os.getenv("TMPDIR"), out_file))
+    proc.start()
+    proc.join()
+    if proc.exitcode:
+        raise RuntimeError(f"Timing mokapot stages failed for {pin}")
+
+    return out_file
+
+
+def brew_stages(pin, out_dir, out_file):
+    """Run mokapot as its CLI does, timing each stage"""
+    import mokapot
+
+    with monitor.StageTimer() as timer:
+        mokapot.Model.fit = timer.wrap(mokapot.Model.fit, "train_fold")
+        mokapot.LinearPsmDataset.assign_confidence = timer.wrap(
+            mokapot.LinearPsmDataset.assign_confidence, "assign_confidence"
+        )
+
+        with timer.stage("total"):
+            with timer.stage("read_pin"):
+                psms = mokapot.read_pin(pin)
+
+            with timer.stage("brew"):
+                results, _ = mokapot.brew(psms)
+
+            with timer.stage("write_results"):
+                results.to_txt(out_dir)
+
+    timer.save(out_file)
+
+
+def benchmark_loaders(pin, rep=None):
+    """Benchmark reading a PIN file as text, as gzipped text, and from its cache"""
+    if rep is None:
+        rep = ""
+    else:
+        rep = f"_{rep}"
+
+    gz_pin = pin + ".gz"
+    if not os.path.isfile(gz_pin):
+        with open(pin, "rb") as f_in, gzip.open(gz_pin, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+    pinfile.read_cache(pin, columns=[])  # Only build the cache, if needed.
+    fileroot = os.path.split(pin)[-1].replace(".pin", rep)
+    out_files = []
+    for loader in LOADERS:
+        out_file = f"loaders/{loader}_{fileroot}.json"
+        out_files.append(out_file)
+        if os.path.isfile(out_file):
+            logging.info(f"{out_file} exist. Skipping...")
+            continue
+
+        logging.info(f"Reading {pin} with the {loader} loader")
+        ctx = multiprocessing.get_context("spawn")
+        proc = ctx.Process(target=load_stages, args=(pin, loader, out_file))
+        proc.start()
+        proc.join()
+        if proc.exitcode:
+            raise RuntimeError(f"The {loader} loader failed for {pin}")
 
-    return out_file[0]
+    return out_files
+
+
+def load_stages(pin, loader, out_file):
+    """Time reading a PIN file into a mokapot dataset with one loader"""
+    import mokapot
+
+    with monitor.StageTimer() as timer:
+        with timer.stage("read_pin"):
+            if loader == "text":
+                mokapot.read_pin(pin)
+            elif loader == "gzip":
+                # mokapot 0.5 opens .gz files in binary mode, which its parser
+                # cannot read, so give the same parser a text stream.
+                with gzip.open(pin + ".gz", "rt") as perc:
+                    cols = perc.readline().rstrip().split("\t")
+                    chunks = mokapot.parsers._parse_in_chunks(perc, cols)
+                    mokapot.read_pin(pd.concat(chunks, copy=False))
+            elif loader == "cache":
+                pinfile.read_pin(pin)
+            else:
+                raise ValueError(f"Unrecognized loader: {loader}")
+
+    timer.save(out_file)
+
+
+def loader_table(stage_files):
+    """Summarize the best time and memory of each loader and PIN size"""
+    res = []
+    for stage_file in stage_files:
+        with open(stage_file) as stages:
+            record = json.load(stages)["stages"][0]
+
+        comp = os.path.basename(stage_file).split("_")
+        res.append(
+            {
+                "loader": comp[0],
+                "psms": int(comp[2]),
+                "time": record["wall_time"],
+                "mem": record["max_rss"],
+            }
+        )
+
+    res = pd.DataFrame(res).groupby(["loader", "psms"]).min().reset_index()
+    return res.sort_values(["psms", "loader"])
+
+
+def percolator_stages(profile_file):
+    """Split a Percolator profile into stages using its log"""
+    out_file = profile_file.replace("profiles/", "stages/")
+    profile = monitor.load_profile(profile_file)
+    records = monitor.log_stages(profile, PERCOLATOR_STAGES)
+    with open(out_file, "w") as out:
+        json.dump({"start": profile["start"], "stages": records}, out)
+
+    return out_file
 
 
 # MAIN ------------------------------------------------------------------------
 def main():
     """The main function"""
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--stages",
+        action="store_true",
+        help="Time each stage of mokapot and Percolator instead of only the CLI.",
+    )
+    parser.add_argument(
+        "--threads",
+        nargs="+",
+        type=int,
+        help="Sweep these numbers of threads and report the parallel scaling.",
+    )
+    parser.add_argument(
+        "--concurrent",
+        type=int,
+        metavar="CORES",
+        help=(
+            "Run benchmarks concurrently, each pinned to CORES cores. "
+            "With --threads, each run gets as many cores as threads."
+        ),
+    )
+    parser.add_argument(
+        "--loaders",
+        action="store_true",
+        help="Compare reading PIN files as text, gzipped text, and from a cache.",
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        metavar="PSMS",
+        help="Benchmark a synthetic PIN file with this many PSMs instead.",
+    )
+    args = parser.parse_args()
+    if (args.stages or args.loaders) and args.concurrent:
+        parser.error("--stages and --loaders cannot be run concurrently.")
 
     np.random.seed(42)
 
+    pin = PIN
+    prefix = "sampled"
+    if args.synthetic:
+        pin = os.path.join(os.getenv("TMPDIR"), f"synthetic_{args.synthetic}.pin")
+        prefix = "synthetic"
+        if not os.path.isfile(pin):
+            synthetic.write_pin(pin, args.synthetic)
+
     pin_dir = os.path.join(os.getenv("TMPDIR"), "pin-out")
     os.makedirs(pin_dir, exist_ok=True)
-    nums = list(np.logspace(4, 7, 7)) + [LENGTH]
-    pins = [
-        sample_psms(int(n), PIN, f"{pin_dir}/sampled_{int(n)}.pin", LENGTH)
-        for n in nums
-    ]
+    total = pinfile.num_psms(pin)
+    nums = [int(n) for n in np.logspace(4, 7, 7) if n < total] + [total]
+    pins = sample_psms(nums, pin, [f"{pin_dir}/{prefix}_{n}.pin" for n in nums])
 
     os.makedirs("logs", exist_ok=True)
-    perc_benchmark = []
-    mp_benchmark = []
-    for r in range(REPS):
-        mp_benchmark += [benchmark(p, True, r) for p in pins]
-        perc_benchmark += [benchmark(p, False, r) for p in pins]
+    os.makedirs("profiles", exist_ok=True)
+    if args.stages:
+        os.makedirs("stages", exist_ok=True)
+        perc_benchmark = []
+        mp_benchmark = []
+        for r in range(REPS):
+            mp_benchmark += [benchmark_stages(p, r) for p in pins]
+            perc_benchmark += [percolator_stages(benchmark(p, False, r)) for p in pins]
+
+        logging.info("DONE!")
+        return
+
+    if args.loaders:
+        os.makedirs("loaders", exist_ok=True)
+        loads = sum([benchmark_loaders(p, r) for r in range(REPS) for p in pins], [])
+        loads = loader_table(loads)
+        loads.to_csv("loaders/loaders.txt", sep="\t", index=False)
+        logging.info("PIN loading:\n%s", loads)
+        logging.info("DONE!")
+        return
+
+    dest = "profiles"
+    threads = [args.concurrent]
+    if args.threads:
+        dest = "scaling"
+        threads = args.threads
+        os.makedirs("logs/scaling", exist_ok=True)
+        os.makedirs("scaling", exist_ok=True)
+
+    runs = [
+        {"tool": tool, "psms": num, "pin": pin, "rep": r, "threads": t}
+        for r in range(REPS)
+        for num, pin in zip(nums, pins)
+        for t in threads
+        for tool in ("mokapot", "percolator")
+    ]
+
+    profiles = execute(runs, dest, args.concurrent)
+    while True:
+        extra = more_reps(runs, profiles)
+        if not extra:
+            break
+
+        runs += extra
+        profiles += execute(extra, dest, args.concurrent)
+
+    results = tabulate(runs, profiles, prefix)
+    past = history.History(HISTORY)
+    report = history.regression_report(results, past.load())
+    report.to_csv(f"logs/{dest}.regression.txt", sep="\t", index=False)
+    past.append(results)
+
+    if args.threads:
+        runs = [{**r, "profile": p} for r, p in zip(runs, profiles)]
+        runs = [{k: r[k] for k in ("tool", "psms", "threads", "profile")} for r in runs]
+        scaling = scaling_table(runs)
+        scaling.to_csv("scaling/scaling.txt", sep="\t", index=False)
+        logging.info("Parallel scaling:\n%s", scaling)
 
     logging.info("DONE!")
 
@@ -2,12 +2,16 @@
 Sample PSMs from the Kim et al then run Percolator and Mokapot
 """
 import os
+import sys
 import logging
-import subprocess
 
 import mokapot
 import pandas as pd
 
+sys.path.append(os.path.join("..", "..", "bin"))
+import search
+import curves
+
 # Setup -----------------------------------------------------------------------
 PIN = os.path.join("..", "scope", "pin-out", "190222S_LCA9_X_FP94_col22.make-pin.pin")
 FASTA = os.path.join("..", "..", "data", "fasta", "human_swissprot_2019-09.fasta")
@@ -32,7 +36,7 @@ def run_mokapot(pin, fasta):
             pin,
         ]
 
-        subprocess.run(cmd, check=True)
+        search.run(cmd, log_file=os.path.join(out_dir, "mokapot.log"))
 
     return out_files
 
@@ -64,7 +68,7 @@ def run_percolator(pin, fasta):
             pin,
         ]
 
-        subprocess.run(cmd, check=True)
+        search.run(cmd, log_file=os.path.join(out_dir, "percolator.log"))
 
     return out_files
 
@@ -73,6 +77,7 @@ def parse_results(res_files):
     """Parse and save the combined results"""
     out_dir = "combined-out"
     os.makedirs(out_dir, exist_ok=True)
+    accepted = {}
     for level in ["psms", "peptides", "proteins"]:
         moka_file = [f for f in res_files if f"mokapot.{level}" in f][0]
         perc_file = [f for f in res_files if f"percolator.{level}" in f][0]
@@ -104,8 +109,12 @@ def parse_results(res_files):
             )
 
         merged = pd.merge(moka_res, perc_res)
-        moka_sum = (moka_res["mokapot q-value"] <= 0.01).sum()
-        perc_sum = (perc_res["percolator q-value"] <= 0.01).sum()
+        moka_curve = curves.accepted(moka_res["mokapot q-value"])
+        perc_curve = curves.accepted(perc_res["percolator q-value"])
+        accepted[level, "mokapot"] = moka_curve
+        accepted[level, "percolator"] = perc_curve
+        moka_sum = moka_curve[curves.THRESHOLDS == 0.01][0]
+        perc_sum = perc_curve[curves.THRESHOLDS == 0.01][0]
 
         logging.info("------------------------------")
         logging.info("%s", level)
@@ -115,11 +124,16 @@ def parse_results(res_files):
 
         merged.to_csv(os.path.join(out_dir, f"{level}.txt"), sep="\t", index=False)
 
+    accepted = pd.DataFrame(accepted, index=curves.THRESHOLDS).T
+    accepted.index.names = ["level", "model"]
+    curves.save(accepted, os.path.join(out_dir, "curves.npz"))
+
 
 # Main ------------------------------------------------------------------------
 def main():
     """The main function"""
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    os.environ.setdefault("STEP_RECORDS", os.path.abspath("steps.jsonl"))
 
     perc_res = run_percolator(PIN, FASTA)
     moka_res = run_mokapot(PIN, FASTA)
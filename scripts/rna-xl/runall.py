@@ -6,6 +6,7 @@ import sys
 import copy
 import shutil
 import logging
+import functools
 
 import mokapot
 import numpy as np
@@ -21,6 +22,10 @@ from sklearn.inspection import permutation_importance
 sys.path.append(os.path.join("..", "..", "bin"))
 import download
 import search
+import pinfile
+import memo
+import digest
+import curves
 
 # Constants and Setup ---------------------------------------------------------
 MISSED_CLEAVAGES = 2
@@ -45,9 +50,6 @@ def run_fragger(mzml_files, fasta, force_=False):
     out_files = [
         os.path.join("fragger-out", os.path.split(f)[-1]) + ".pin" for f in base
     ]
-    all_exist = all([os.path.isfile(f) for f in out_files])
-    if all_exist and not force_:
-        return out_files
 
     fragger_args = {
         "database_name": fasta,
@@ -66,14 +68,25 @@ def run_fragger(mzml_files, fasta, force_=False):
         "report_alternative_proteins": "1",
     }
 
+    memo.memoize(
+        functools.partial(search_fragger, mzml_files, fragger_args),
+        outputs=out_files + [f.replace(".pin", ".tsv") for f in out_files],
+        inputs=mzml_files + [fasta],
+        tool=search.msfragger_version(),
+        force=force_,
+    )
+
+    return out_files
+
+
+def search_fragger(mzml_files, fragger_args):
+    """Search with MSFragger and move the results to fragger-out"""
     search.msfragger(mzml_files, **fragger_args)
-    for frag in base:
+    for frag in [os.path.splitext(f)[0] for f in mzml_files]:
         out = os.path.join("fragger-out", os.path.split(frag)[-1])
         for ext in (".tsv", ".pin"):
             shutil.move(frag + ext, out + ext)
 
-    return out_files
-
 
 def update_fragger(pin_files, top_match=5):
     """Update the pin files."""
@@ -82,44 +95,51 @@ def update_fragger(pin_files, top_match=5):
     for pin in pin_files:
         out_file = os.path.join("pin-out", os.path.basename(pin))
         out_files.append(out_file)
-        if os.path.isfile(out_file):
-            continue
-
         tsv = pin.replace(".pin", ".tsv")
-        tsv_df = pd.read_csv(tsv, sep="\t")
-        pin_df = mokapot.read_pin(pin, to_df=True).drop("ExpMass", axis=1)
-        pin_df = pin_df.rename(columns={"ExpMass": "CalcMass"})
-        cols = [
-            "scannum",
-            "hit_rank",
-            "precursor_neutral_mass",
-            "massdiff",
-        ]
-        tsv_df = tsv_df.loc[:, cols].rename(
-            columns={
-                "scannum": "ScanNr",
-                "hit_rank": "rank",
-                "precursor_neutral_mass": "ExpMass",
-            }
+        memo.memoize(
+            functools.partial(update_pin, pin, tsv, out_file, top_match),
+            outputs=[out_file],
+            inputs=[pin, tsv],
+            tool=mokapot.__version__,
         )
 
-        pin_df = pd.merge(tsv_df, pin_df)
-        pin_df["group"] = "unmodified"
-        pin_df.loc[pin_df["abs_ppm"] > 50, "group"] = "modified"
+    return out_files
 
-        new_cols = ["group"] + list(pin_df.columns)[: pin_df.shape[1] - 1]
-        pin_df = pin_df.loc[:, new_cols]
-        pin_df["Peptide"] = (
-            pin_df["Peptide"] + "[" + pin_df["massdiff"].round(2).astype(str) + "]"
-        )
 
-        pin_df = pin_df.loc[pin_df["rank"] <= top_match, :].drop(
-            columns=["delta_hyperscore", "massdiff"]
-        )
+def update_pin(pin, tsv, out_file, top_match):
+    """Add the precursor mass and groups from the MSFragger tsv file"""
+    tsv_df = pd.read_csv(tsv, sep="\t")
+    pin_df = mokapot.read_pin(pin, to_df=True).drop("ExpMass", axis=1)
+    pin_df = pin_df.rename(columns={"ExpMass": "CalcMass"})
+    cols = [
+        "scannum",
+        "hit_rank",
+        "precursor_neutral_mass",
+        "massdiff",
+    ]
+    tsv_df = tsv_df.loc[:, cols].rename(
+        columns={
+            "scannum": "ScanNr",
+            "hit_rank": "rank",
+            "precursor_neutral_mass": "ExpMass",
+        }
+    )
 
-        pin_df.to_csv(out_file, index=False, sep="\t")
+    pin_df = pd.merge(tsv_df, pin_df)
+    pin_df["group"] = "unmodified"
+    pin_df.loc[pin_df["abs_ppm"] > 50, "group"] = "modified"
 
-    return out_files
+    new_cols = ["group"] + list(pin_df.columns)[: pin_df.shape[1] - 1]
+    pin_df = pin_df.loc[:, new_cols]
+    pin_df["Peptide"] = (
+        pin_df["Peptide"] + "[" + pin_df["massdiff"].round(2).astype(str) + "]"
+    )
+
+    pin_df = pin_df.loc[pin_df["rank"] <= top_match, :].drop(
+        columns=["delta_hyperscore", "massdiff"]
+    )
+
+    pin_df.to_csv(out_file, index=False, sep="\t")
 
 
 def run_mokapot(psms, model="linear", force_=False):
@@ -193,13 +213,23 @@ def parse_results(res_files):
             models[label] = mokapot.load_model(model_file)
 
     results = (psms, peptides, proteins, models)
+    qvalues = pd.concat(
+        [
+            df[["mokapot q-value"]].assign(level=level, model=label)
+            for level, res in zip(("PSMs", "peptides", "proteins"), results[:3])
+            for label, df in res.items()
+        ]
+    )
+    accepted = curves.group_curves(qvalues, ["level", "model"])
+    curves.save(accepted, os.path.join("mokapot-out", "curves.npz"))
+
     logging.info("")
     logging.info("=== Results ===")
     logging.info("%s", res_files)
-    for level, res in zip(("PSMs", "peptides", "proteins"), results[:3]):
+    for level in ("PSMs", "peptides", "proteins"):
         logging.info(level)
-        for label, df in res.items():
-            num_passing = (df["mokapot q-value"] <= 0.01).sum()
+        for label in psms:
+            num_passing = accepted.loc[(level, label), 0.01]
             logging.info("\t%s:  %i", label, num_passing)
 
     return results
@@ -256,18 +286,23 @@ def main():
 
     mzml_files = download.rnaxl(EXPERIMENT)
     td_fasta = "yeast_target-decoy.fasta"
-    if not os.path.isfile(td_fasta):
-        mokapot.make_decoys(FASTA, td_fasta)
+    memo.memoize(
+        functools.partial(mokapot.make_decoys, FASTA, td_fasta),
+        outputs=[td_fasta],
+        inputs=[FASTA],
+        tool=mokapot.__version__,
+    )
 
     logging.info("Performing Searches...")
     search_res = run_fragger(mzml_files, td_fasta)
     pins = update_fragger(search_res, top_match=TOP_MATCH)
 
     logging.info("Reading Search Results...")
-    psms = mokapot.read_pin(pins, group_column="group")
+    psms = pinfile.read_pin(pins, group_column="group")
     logging.info("\n%s", psms._data.groupby("group")["Label"].value_counts())
 
-    psms.add_proteins(td_fasta, missed_cleavages=MISSED_CLEAVAGES)
+    prots = digest.fasta_proteins(td_fasta, missed_cleavages=MISSED_CLEAVAGES)
+    psms.add_proteins(prots)
 
     logging.info("Training models...")
     res_files = [run_mokapot(psms, m) for m in models]
@@ -6,9 +6,14 @@ a static model when the number of datasets is large.
 """
 import os
 import sys
+import glob
+import zlib
 import logging
-import subprocess
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
+import psutil
 import mokapot
 import numpy as np
 import pandas as pd
@@ -16,12 +21,42 @@ import pandas as pd
 sys.path.append(os.path.join("..", "..", "bin"))
 import search
 import download
+import pinfile
+import memo
+import digest
+import resultstore
+import curves
 
 # Setup -----------------------------------------------------------------------
-np.random.seed(42)
+SEED = 42
+np.random.seed(SEED)
 FASTA = os.path.join("..", "..", "data", "fasta", "human_swissprot_2019-09.fasta")
 MISSED_CLEAVAGES = 2
 
+# The resources used by each step are recorded here.
+STEP_RECORDS = "steps.jsonl"
+
+# Each search gets this many cores and is expected to need this much memory.
+SEARCH_THREADS = 4
+SEARCH_MEMORY = "4G"
+
+# The pin files are scored by at most this many processes at once. Each
+# holds a whole pin file, which takes about PIN_MEMORY_FACTOR times its size
+# in memory, so fewer are used if they would not fit in MOKAPOT_MEMORY
+# (by default, the memory available when they start).
+MOKAPOT_WORKERS = int(os.getenv("MOKAPOT_WORKERS", len(os.sched_getaffinity(0))))
+MOKAPOT_MEMORY = os.getenv("MOKAPOT_MEMORY")
+PIN_MEMORY_FACTOR = 10
+
+# The results of every model are saved here, partitioned by pin file.
+RESULTS = os.path.join("mokapot-out", "results")
+
+# The number of PSMs drawn from each pin file to train subsampled joint
+# models, and the numbers compared in the subsampling experiment.
+JOINT_TRAIN_SIZE = 10000
+SUBSAMPLE_SIZES = [1000, 2000, 5000, 10000, 20000]
+FOLDS = 3
+
 
 # Functions ------------------------------------------------------------------
 def make_index(fasta_file, name="human.index"):
@@ -35,37 +70,44 @@ def make_index(fasta_file, name="human.index"):
         "output-dir": "index-out",
     }
 
-    if not os.path.isdir(name):
-        search.tide_index(fasta_file, name, **params)
+    memo.memoize(
+        functools.partial(search.tide_index, fasta_file, name, **params),
+        outputs=[name],
+        inputs=[fasta_file],
+        tool=search.crux_version(),
+    )
 
     return name
 
 
-def tide2pin(target, name):
+def tide2pin(target, name, log_file=None, cpus=None):
     """Convert tide results to a pin file."""
     out_file = f"pin-out/{name}.make-pin.pin"
+    cmd = [
+        "crux",
+        "make-pin",
+        "--max-charge-feature",
+        "5",
+        "--output-dir",
+        "pin-out",
+        "--top-match",
+        "5",
+        "--fileroot",
+        name,
+        target,
+    ]
 
-    if not os.path.isfile(out_file):
-        cmd = [
-            "crux",
-            "make-pin",
-            "--max-charge-feature",
-            "5",
-            "--output-dir",
-            "pin-out",
-            "--top-match",
-            "5",
-            "--fileroot",
-            name,
-            target,
-        ]
-
-        subprocess.run(cmd, check=True)
+    memo.memoize(
+        functools.partial(search.run, cmd, log_file=log_file, cpus=cpus),
+        outputs=[out_file],
+        inputs=[target, target.replace(".target.", ".decoy.")],
+        tool=search.crux_version(),
+    )
 
     return out_file
 
 
-def run_tide(mzml_files, name, index):
+def run_tide(mzml_files, name, index, log_file=None, cpus=None):
     """Perform a tide search"""
     if isinstance(mzml_files, str):
         mzml_files = [mzml_files]
@@ -88,14 +130,26 @@ def run_tide(mzml_files, name, index):
         "concat": "F",
     }
 
-    if not os.path.isfile(out_file):
-        search.tide(mzml_files, index, **params)
+    memo.memoize(
+        functools.partial(
+            search.tide, mzml_files, index, log_file=log_file, cpus=cpus, **params
+        ),
+        outputs=[out_file, out_file.replace(".target.", ".decoy.")],
+        inputs=mzml_files + [index],
+        tool=search.crux_version(),
+    )
 
     return out_file
 
 
-def load_pins(pin_dir="pin-out", train=False, fasta=None):
-    """Load the pin files."""
+def search_files(mzml_files, name, index, log_file=None, cpus=None):
+    """Perform a tide search and convert the results to a pin file"""
+    target = run_tide(mzml_files, name, index, log_file=log_file, cpus=cpus)
+    return tide2pin(target, name, log_file=log_file, cpus=cpus)
+
+
+def list_pins(pin_dir="pin-out", train=False):
+    """List the pin files."""
     if train:
         pin_files = ["qc.make-pin.pin"]
     else:
@@ -109,12 +163,16 @@ def load_pins(pin_dir="pin-out", train=False, fasta=None):
         "190222S_LCA9_X_FP94AO.make-pin.pin",
     ]
     pin_files = [p for p in pin_files if p not in small_files]
+    return [os.path.join(pin_dir, p) for p in pin_files]
 
-    pin_files = [os.path.join(pin_dir, p) for p in pin_files]
-    psms = [mokapot.read_pin(p) for p in pin_files]
+
+def load_pins(pin_dir="pin-out", train=False, fasta=None):
+    """Load the pin files."""
+    pin_files = list_pins(pin_dir, train)
+    psms = [pinfile.read_pin(p) for p in pin_files]
 
     if fasta is not None:
-        prots = mokapot.FastaProteins(fasta, missed_cleavages=MISSED_CLEAVAGES)
+        prots = digest.fasta_proteins(fasta, missed_cleavages=MISSED_CLEAVAGES)
         for dat in psms:
             dat.add_proteins(prots)
 
@@ -123,99 +181,303 @@ def load_pins(pin_dir="pin-out", train=False, fasta=None):
 
 def run_mokapot(model_type, fasta):
     """Run mokapot with a certain type of model"""
-    out_dir = "mokapot-out"
-    out_files = [
-        os.path.join(out_dir, model_type + l + ".txt.gz")
-        for l in (".psms", ".peptides", ".proteins")
-    ]
-
-    if all([os.path.isfile(f) for f in out_files]):
-        return tuple(pd.read_csv(f, sep="\t") for f in out_files)
-
-    os.makedirs(out_dir, exist_ok=True)
+    params = {"missed_cleavages": MISSED_CLEAVAGES}
+    if model_type == "subsampled":
+        params.update(train_size=JOINT_TRAIN_SIZE, folds=FOLDS, seed=SEED)
+
+    out_dirs = resultstore.model_dirs(RESULTS, model_type)
+    memo.memoize(
+        functools.partial(
+            search.run_step, f"mokapot-{model_type}", fit_mokapot, model_type, fasta
+        ),
+        outputs=out_dirs,
+        inputs=sorted(glob.glob(os.path.join("pin-out", "*.pin"))) + [fasta],
+        params=params,
+        tool=mokapot.__version__,
+    )
+
+    return out_dirs
+
+
+def run_subsampling(fasta, sizes=SUBSAMPLE_SIZES):
+    """Count the PSMs accepted by joint models trained on subsamples"""
+    out_file = os.path.join("mokapot-out", "subsampling.txt")
+    memo.memoize(
+        functools.partial(
+            search.run_step,
+            "mokapot-subsampling",
+            subsampling_experiment,
+            fasta,
+            out_file,
+            sizes,
+        ),
+        outputs=[out_file],
+        inputs=sorted(glob.glob(os.path.join("pin-out", "*.pin"))) + [fasta],
+        params={"folds": FOLDS, "seed": SEED},
+        tool=mokapot.__version__,
+    )
+
+    return pd.read_csv(out_file, sep="\t")
+
+
+def subsampling_experiment(fasta, out_file, sizes):
+    """Train a subsampled joint model for each size and count accepted PSMs"""
+    pins = list_pins()
+    rows = []
+    for size in sizes:
+        models, num_train = train_joint(pins, size)
+        accepted = 0
+        for tables in score_files(pins, fasta, models):
+            if tables is not None:
+                accepted += int((tables[0]["mokapot q-value"] <= 0.01).sum())
+
+        logging.info("%i PSMs per file: %i accepted PSMs", size, accepted)
+        rows.append({"size": size, "train_psms": num_train, "accepted": accepted})
+
+    rows = pd.DataFrame(rows)
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    rows.to_csv(out_file, sep="\t", index=False)
+    return rows
+
+
+def fit_mokapot(model_type, fasta):
+    """Fit a certain type of model and save the results"""
+    pins = list_pins()
     if model_type == "static":
         train, _ = load_pins(train=True)
         model = mokapot.PercolatorModel()
         model.fit(train[0])
         del train
-        test, pins = load_pins(fasta=fasta)
-        results = [d.assign_confidence(model.predict(d)) for d in test]
-        results = aggregate_results(results, pins)
+        results = score_files(pins, fasta, model)
 
     elif model_type == "independent":
-        test, pins = load_pins(fasta=fasta)
         model = mokapot.PercolatorModel(override=True)
-        results = []
-        for d in test:
-            try:
-                res = mokapot.brew(d, model)[0]
-            except (ValueError, RuntimeError) as e:
-                res = None
-                logging.warning("Brew failed for %s.", d)
-                logging.warning("\t- Caught: %s", e)
-
-            results.append(res)
-
-        results = aggregate_results(results, pins)
+        results = score_files(pins, fasta, model, brew=True)
 
     elif model_type == "joint":
         test, pins = load_pins(fasta=fasta)
         model = mokapot.PercolatorModel(override=True)
-        results = aggregate_results(mokapot.brew(test, model)[0], pins)
+        results = mokapot.brew(test, model)[0]
+        results = [(r.psms, r.peptides, r.proteins) for r in results]
+
+    elif model_type == "subsampled":
+        models, _ = train_joint(pins, JOINT_TRAIN_SIZE)
+        results = score_files(pins, fasta, models)
 
     elif model_type == "tide":
-        test, pins = load_pins(fasta=fasta)
-        results = [d.assign_confidence() for d in test]
-        results = aggregate_results(results, pins)
+        results = score_files(pins, fasta)
 
     else:
         raise ValueError("Unrecognized model_type")
 
-    _ = [r.to_csv(f, sep="\t", index=False) for r, f in zip(results, out_files)]
+    store_results(results, pins, model_type)
+
 
-    return results
+def store_results(results, pins, model_type):
+    """Save the results of each pin file as they arrive"""
+    resultstore.clear(RESULTS, model_type)
+    for pin, tables in zip(pins, results):
+        if tables is not None:
+            resultstore.write(RESULTS, model_type, pin, tables)
 
 
-def aggregate_results(results, pins):
-    """Aggregate the results"""
-    psms = []
-    peps = []
-    prots = []
-    for res, pin in zip(results, pins):
-        if res is None:
+def mokapot_workers(pin_files, workers=None):
+    """The number of pin files that can be processed at once in memory"""
+    if workers is None:
+        workers = MOKAPOT_WORKERS
+
+    if MOKAPOT_MEMORY is None:
+        budget = psutil.virtual_memory().available / 1e6
+    else:
+        budget = search.megabytes(MOKAPOT_MEMORY)
+
+    largest = max([os.path.getsize(p) for p in pin_files], default=0) / 1e6
+    if largest:
+        workers = min(workers, int(budget // (largest * PIN_MEMORY_FACTOR)))
+
+    return max(min(workers, len(pin_files)), 1)
+
+
+def map_files(func, pin_files, *args, workers=None):
+    """Apply a function to each pin file in parallel, yielding results in order"""
+    workers = mokapot_workers(pin_files, workers)
+    logging.info("Processing %i pin files with %i workers...", len(pin_files), workers)
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for pin in pin_files:
+            # Only as many files as workers are loaded or waiting at once.
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+
+            pending.append(pool.submit(func, pin, *args, seed=file_seed(pin)))
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def score_files(pin_files, fasta, model=None, brew=False, workers=None):
+    """Score the pin files in parallel, yielding their results in order"""
+    return map_files(score_file, pin_files, fasta, model, brew, workers=workers)
+
+
+def score_file(pin, fasta, model=None, brew=False, seed=None):
+    """Score one pin file, with a model, fold models, or by brewing a new one"""
+    np.random.seed(seed)
+    logging.info("Scoring %s...", pin)
+    dat = pinfile.read_pin(pin)
+    dat.add_proteins(digest.fasta_proteins(fasta, missed_cleavages=MISSED_CLEAVAGES))
+    if brew:
+        try:
+            res = mokapot.brew(dat, model)[0]
+        except (ValueError, RuntimeError) as e:
+            logging.warning("Brew failed for %s.", dat)
+            logging.warning("\t- Caught: %s", e)
+            return None
+    elif isinstance(model, list):
+        folds = spectrum_folds(dat, len(model), seed)
+        res = dat.assign_confidence(fold_scores(dat, model, folds))
+    else:
+        scores = None if model is None else model.predict(dat)
+        res = dat.assign_confidence(scores)
+
+    return res.psms, res.peptides, res.proteins
+
+
+def train_joint(pin_files, size, folds=FOLDS, workers=None):
+    """Train cross-validated joint models on a subsample of each pin file"""
+    samples = list(map_files(subsample_file, pin_files, size, folds, workers=workers))
+    train = pd.concat([s[0] for s in samples], ignore_index=True)
+    train_folds = np.concatenate([s[1] for s in samples])
+    del samples
+
+    logging.info("Training joint models on %i PSMs...", len(train))
+    np.random.seed(SEED)
+    models = []
+    for fold in range(folds):
+        fold_set = mokapot.read_pin(train.loc[train_folds != fold])
+        model = mokapot.PercolatorModel(override=True)
+        model.fit(fold_set)
+        models.append(model)
+
+    return models, len(train)
+
+
+def subsample_file(pin, size, folds, seed=None):
+    """Draw PSMs from a pin file, keeping its proportion of targets and decoys"""
+    dat = pinfile.read_pin(pin)
+    rng = np.random.default_rng([seed, size])
+    frac = min(1, size / max(len(dat.data), 1))
+    targets = dat.targets.astype(bool)
+    rows = []
+    for label in (True, False):
+        label_rows = np.flatnonzero(targets == label)
+        num = int(round(frac * len(label_rows)))
+        rows.append(rng.choice(label_rows, num, replace=False))
+
+    rows = np.sort(np.concatenate(rows))
+    spectrum_fold = spectrum_folds(dat, folds, seed)
+    return dat.data.iloc[rows].reset_index(drop=True), spectrum_fold[rows]
+
+
+def spectrum_folds(dat, folds, seed):
+    """Assign each PSM to a fold, keeping the PSMs of a spectrum together"""
+    key = f"{seed:016x}"[-16:]
+    hashes = pd.util.hash_pandas_object(dat.spectra, index=False, hash_key=key)
+    return (hashes.to_numpy() % folds).astype(int)
+
+
+def fold_scores(dat, models, folds, test_fdr=0.01):
+    """Score the PSMs of each fold with the model that was not trained on it"""
+    scores = np.zeros(len(dat.data))
+    for fold, model in enumerate(models):
+        in_fold = folds == fold
+        if not in_fold.any():
             continue
 
-        res.psms["pin_file"] = pin
-        res.peptides["pin_file"] = pin
-        res.proteins["pin_file"] = pin
-        psms.append(res.psms)
-        peps.append(res.peptides)
-        prots.append(res.proteins)
+        # mokapot has no public way to calibrate scores. This is what brew()
+        # does in mokapot 0.5, which environment.yml pins.
+        fold_set = mokapot.read_pin(dat.data.loc[in_fold])
+        scores[in_fold] = fold_set._calibrate_scores(model.predict(fold_set), test_fdr)
+
+    return scores
+
+
+def file_seed(pin):
+    """The random seed for a pin file, which does not depend on the others"""
+    name = os.path.basename(pin).encode()
+    return int(np.random.SeedSequence([SEED, zlib.crc32(name)]).generate_state(1)[0])
+
 
-    return pd.concat(psms), pd.concat(peps), pd.concat(prots)
+def run_curves(model_types):
+    """Count the accepted results of each model over a grid of q-values"""
+    out_file = os.path.join("mokapot-out", "curves.npz")
+    memo.memoize(
+        functools.partial(save_curves, model_types, out_file),
+        outputs=[out_file],
+        inputs=[d for m in model_types for d in resultstore.model_dirs(RESULTS, m)],
+        params={"thresholds": curves.THRESHOLDS.tolist()},
+    )
+
+    accepted = curves.load(out_file)
+    totals = accepted[0.01].groupby(["level", "model"]).sum().unstack("level")
+    logging.info("Accepted at 1%% FDR:\n%s", totals)
+    return accepted
+
+
+def save_curves(model_types, out_file):
+    """Save the acceptance curves of each model, level, and pin file"""
+    return curves.save(curves.store_curves(RESULTS, model_types), out_file)
+
+
+def summarize_steps(record_file):
+    """Log the total resources used by each step of the pipeline"""
+    if not os.path.isfile(record_file):
+        return
+
+    steps = pd.read_json(record_file, lines=True)
+    steps = steps.groupby("step").agg(
+        runs=("step", "size"),
+        wall_time=("wall_time", "sum"),
+        cpu_time=("cpu_time", "sum"),
+        max_rss=("max_rss", "max"),
+    )
+    steps["wall_fraction"] = steps["wall_time"] / steps["wall_time"].sum()
+    steps = steps.sort_values("wall_time", ascending=False)
+    logging.info("Resources used by each step:\n%s", steps)
+    return steps
 
 
 # MAIN ------------------------------------------------------------------------
 def main():
     """Run the analyses"""
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    os.environ.setdefault("STEP_RECORDS", os.path.abspath(STEP_RECORDS))
     logging.info("##### Getting Files #####")
     mzml = download.scope2()
 
     logging.info("##### Making Index #####")
     index = make_index(FASTA)
 
-    logging.info("##### Performing QC searches #####")
+    logging.info("##### Performing searches #####")
+    runner = search.JobRunner(log_dir="search-logs")
     qc_name = "qc"
     qc_files = [f for f in mzml if "_QC_" in f and f.endswith("mzML.gz")]
-    qc_tide = run_tide(qc_files, qc_name, index)
-    qc_pin = tide2pin(qc_tide, name=qc_name)
-
-    logging.info("##### Performing main searches #####")
     x_files = [f for f in mzml if "_X_" in f and f.endswith("mzML.gz")]
     x_names = [os.path.split(f.replace(".mzML.gz", ""))[-1] for f in x_files]
-    x_tide = [run_tide(f, n, index) for f, n in zip(x_files, x_names)]
-    x_pins = [tide2pin(f, name=n) for f, n in zip(x_tide, x_names)]
+    jobs = [
+        runner.submit(
+            search_files,
+            f,
+            n,
+            index,
+            name=n,
+            threads=SEARCH_THREADS,
+            memory=SEARCH_MEMORY,
+        )
+        for f, n in zip([qc_files] + x_files, [qc_name] + x_names)
+    ]
+
+    qc_pin, *x_pins = [j.result() for j in jobs]
 
     logging.info("##### Static Model #####")
     static = run_mokapot("static", FASTA)
@@ -226,9 +488,19 @@ def main():
     logging.info("##### Joint Models #####")
     joint = run_mokapot("joint", FASTA)
 
+    logging.info("##### Subsampled Joint Models #####")
+    subsampled = run_mokapot("subsampled", FASTA)
+    subsampling = run_subsampling(FASTA)
+
     logging.info("##### No model #####")
     tide = run_mokapot("tide", FASTA)
 
+    logging.info("##### Acceptance Curves #####")
+    run_curves(["static", "independent", "joint", "subsampled", "tide"])
+
+    logging.info("##### Resources #####")
+    summarize_steps(os.environ["STEP_RECORDS"])
+
     logging.info("##### DONE! #####")
 
 